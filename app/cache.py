@@ -0,0 +1,118 @@
+"""
+報表結果快取模組
+========================
+報表/期間查詢對所有使用者、每次重新整理都算出相同結果，
+因此以 (端點, 參數, 資料版本) 為鍵快取在程序內：
+
+- 資料版本為各月份的 data:YYYY-MM 版本號，上課/賣課寫入、重算、關帳/開帳時遞增
+- 涵蓋的月份全部已關帳時結果不會再變，固定保存 (不受 LRU 淘汰)
+- 其餘結果以 LRU 限制筆數；版本變動後舊結果不再命中，自然被淘汰
+- 多個 worker 各自快取，以資料庫中的版本號判斷是否過期
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+from decouple import config
+from sqlalchemy.orm import Session
+
+from .shared_state import get_month_states, get_settings, get_total_data_version
+
+# LRU 最多保存的結果數 (不含已關帳期間的固定結果)
+REPORT_CACHE_SIZE = config("REPORT_CACHE_SIZE", default=512, cast=int)
+
+
+class ReportCache:
+    """以版本為鍵的 LRU 快取，已關帳期間的結果另外固定保存"""
+
+    def __init__(self, maxsize: int = REPORT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[Hashable, Tuple], Any]" = OrderedDict()
+        # 固定保存：每組 (端點, 參數) 只保留一份，版本不同時直接取代
+        self._pinned: Dict[Hashable, Tuple[Tuple, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, versions: Tuple) -> Optional[Any]:
+        with self._lock:
+            pinned = self._pinned.get(key)
+            if pinned is not None:
+                if pinned[0] == versions:
+                    self.hits += 1
+                    return pinned[1]
+                # 已重新開帳或資料變動：固定結果失效
+                del self._pinned[key]
+                self.evictions += 1
+            entry_key = (key, versions)
+            if entry_key in self._entries:
+                self._entries.move_to_end(entry_key)
+                self.hits += 1
+                return self._entries[entry_key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, versions: Tuple, value: Any, pin: bool = False):
+        with self._lock:
+            if pin:
+                self._pinned[key] = (versions, value)
+                return
+            self._entries[(key, versions)] = value
+            self._entries.move_to_end((key, versions))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pinned.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "pinned": len(self._pinned),
+                "maxsize": self.maxsize,
+            }
+
+
+report_cache = ReportCache()
+
+
+def cached(
+    db: Session,
+    endpoint: str,
+    params: Hashable,
+    months: Optional[Iterable[Tuple[int, int]]],
+    compute: Callable[[], Any],
+    extra_keys: Tuple[str, ...] = ()
+) -> Any:
+    """
+    取得快取結果，未命中時呼叫 compute() 並存入
+    months: 結果涵蓋的 (年, 月)；None 表示不限期間 (以所有月份的版本總和判斷)
+    extra_keys: 其他影響結果的設定版本 (例如教練/課程名稱的 REFERENCE_KEY)
+    """
+    if months is None:
+        versions = (get_total_data_version(db),)
+        closed = False
+    else:
+        states = get_month_states(db, months)
+        versions = tuple(version for version, _ in states.values())
+        closed = bool(states) and all(is_closed for _, is_closed in states.values())
+    if extra_keys:
+        settings = get_settings(db, list(extra_keys))
+        versions += tuple(settings[key].version if key in settings else 0 for key in extra_keys)
+
+    key = (endpoint, params)
+    value = report_cache.get(key, versions)
+    if value is None:
+        value = compute()
+        report_cache.put(key, versions, value, pin=closed)
+    return value
@@ -1,9 +1,185 @@
+import json
+from pydantic import ValidationError
+from sqlalchemy import Float, Integer, String, case, cast, func, literal_column, null, or_, select, union_all, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from typing import List, Optional
-from datetime import date
-
-from . import models, schemas
-from .salary_rules import calculate_salary, calculate_commission
+from typing import Callable, List, Optional, Sequence, Tuple
+from datetime import date, datetime, timedelta
+
+from . import models, schemas, payroll, reports
+from .shared_state import REFERENCE_KEY, bump_version, data_key, set_setting
+from .salary_rules import calculate_salary, calculate_commission, check_inference_limit, infer_sale_items, load_rules
+
+
+class MonthClosedError(Exception):
+    """該月份已關帳，拒絕新增或刪除紀錄"""
+
+    def __init__(self, year: int, month: int):
+        self.year = year
+        self.month = month
+        super().__init__(f"{year}年{month}月 已關帳，如需修改請先重新開帳")
+
+
+def resolve_fields(model, fields: str) -> list:
+    """
+    將 fields="date,amount" 轉為欄位清單 (用於投影查詢，只 SELECT 需要的欄位)
+    未知欄位拋出 ValueError
+    """
+    columns = model.__table__.columns
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in columns]
+    if unknown:
+        raise ValueError(f"未知欄位: {', '.join(unknown)}")
+    return [getattr(model, name) for name in dict.fromkeys(names)]
+
+
+# expand 可展開的關聯：名稱 -> (關聯表, 加入的欄位, join 條件)
+EXPANSIONS = {
+    models.Attendance: {
+        "teacher": (models.Teacher, [models.Teacher.name.label("teacher_name")], models.Attendance.teacher_id == models.Teacher.id),
+        "course": (models.Course, [models.Course.name.label("course_name"), models.Course.course_type.label("course_type")], models.Attendance.course_id == models.Course.id),
+    },
+    models.Sales: {
+        "teacher": (models.Teacher, [models.Teacher.name.label("teacher_name")], models.Sales.teacher_id == models.Teacher.id),
+    },
+}
+
+
+def resolve_expand(model, expand: str) -> list:
+    """
+    將 expand="teacher,course" 轉為 join 清單 [(關聯表, 欄位, join 條件), ...]
+    名稱欄位在同一個 SELECT 內以 join 取得，不會逐列 lazy load
+    未知關聯拋出 ValueError
+    """
+    available = EXPANSIONS.get(model, {})
+    names = [name.strip() for name in expand.split(",") if name.strip()]
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ValueError(f"無法展開: {', '.join(unknown)} (可用: {', '.join(available)})")
+    return [available[name] for name in dict.fromkeys(names)]
+
+
+def _listing_columns(model, joins: Optional[list]) -> dict:
+    """可排序/篩選的欄位：資料表欄位 + expand 加入的關聯欄位"""
+    available = {column.name: getattr(model, column.name) for column in model.__table__.columns}
+    for _, extra_columns, _ in joins or []:
+        for label in extra_columns:
+            available[label.name] = label.element
+    return available
+
+
+def resolve_sort(model, sort: str, joins: Optional[list] = None) -> list:
+    """
+    將 sort="-date,teacher_name" 轉為 ORDER BY 清單 (- 表示遞減)
+    最後固定加上 id，確保分頁結果穩定；未知欄位拋出 ValueError
+    """
+    available = _listing_columns(model, joins)
+    order_by = []
+    for name in (name.strip() for name in sort.split(",")):
+        if not name:
+            continue
+        descending = name.startswith("-")
+        name = name.lstrip("-")
+        if name not in available:
+            raise ValueError(f"無法排序: {name}")
+        order_by.append(available[name].desc() if descending else available[name].asc())
+    order_by.append(model.id.asc())
+    return order_by
+
+
+# 篩選運算子：filter=欄位:運算子:值
+FILTER_OPERATORS = {
+    "eq": lambda column, value: column == value,
+    "ne": lambda column, value: column != value,
+    "lt": lambda column, value: column < value,
+    "lte": lambda column, value: column <= value,
+    "gt": lambda column, value: column > value,
+    "gte": lambda column, value: column >= value,
+    "contains": lambda column, value: column.icontains(value, autoescape=True),
+    "in": lambda column, value: column.in_(value),
+}
+
+
+def _coerce_filter_value(column, raw: str):
+    """依欄位型別轉換篩選值"""
+    python_type = column.type.python_type
+    if python_type is date:
+        return date.fromisoformat(raw)
+    if python_type in (int, float):
+        return python_type(raw)
+    return raw
+
+
+def resolve_filters(model, filters: List[str], joins: Optional[list] = None) -> list:
+    """
+    將 ["date:gte:2025-01-01", "teacher_name:contains:小美", "teacher_id:in:1|2"] 轉為 WHERE 條件
+    未知欄位/運算子或無法轉換的值拋出 ValueError
+    """
+    available = _listing_columns(model, joins)
+    criteria = []
+    for item in filters:
+        parts = item.split(":", 2)
+        if len(parts) != 3:
+            raise ValueError(f"篩選格式應為 欄位:運算子:值，收到: {item}")
+        name, op, raw = parts
+        if name not in available:
+            raise ValueError(f"無法篩選: {name}")
+        if op not in FILTER_OPERATORS:
+            raise ValueError(f"未知運算子: {op} (可用: {', '.join(FILTER_OPERATORS)})")
+        column = available[name]
+        try:
+            if op == "contains":
+                value = raw
+            elif op == "in":
+                value = [_coerce_filter_value(column, part) for part in raw.split("|")]
+            else:
+                value = _coerce_filter_value(column, raw)
+        except ValueError:
+            raise ValueError(f"篩選值格式錯誤: {item}")
+        criteria.append(FILTER_OPERATORS[op](column, value))
+    return criteria
+
+
+def _select_rows(
+    db: Session,
+    columns: list,
+    *criteria,
+    joins: Optional[list] = None,
+    order_by: Optional[list] = None,
+    skip: Optional[int] = None,
+    limit: Optional[int] = None
+) -> list:
+    """
+    以 SQLAlchemy Core 只 SELECT 指定欄位，回傳純 tuple 列 (Row)
+    不建立 ORM 物件、不進 identity map，適合大量讀取後直接序列化
+    joins 來自 resolve_expand，關聯欄位以 LEFT JOIN 加在同一個 SELECT
+    """
+    stmt = select(*columns)
+    if joins:
+        stmt = stmt.select_from(columns[0].class_)
+        for target, extra_columns, onclause in joins:
+            stmt = stmt.outerjoin(target, onclause).add_columns(*extra_columns)
+    stmt = stmt.where(*criteria)
+    if order_by:
+        stmt = stmt.order_by(*order_by)
+    if skip:
+        stmt = stmt.offset(skip)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return db.execute(stmt).all()
+
+
+def count_rows(db: Session, model, *criteria, joins: Optional[list] = None) -> int:
+    """計算符合條件的筆數 (分頁總數，X-Total-Count)"""
+    stmt = select(func.count(model.id)).select_from(model)
+    for target, _, onclause in joins or []:
+        stmt = stmt.outerjoin(target, onclause)
+    return db.execute(stmt.where(*criteria)).scalar()
+
+
+def _log_change(db: Session, kind: str, op: str, record_id: int, record_date: date):
+    """寫入異動日誌 (與紀錄本身在同一個交易)"""
+    db.add(models.RecordChange(kind=kind, op=op, record_id=record_id, record_date=record_date))
 
 
 # ========== Teacher CRUD ==========
@@ -11,6 +187,7 @@ def create_teacher(db: Session, teacher: schemas.TeacherCreate) -> models.Teache
     """建立新教練"""
     db_teacher = models.Teacher(name=teacher.name)
     db.add(db_teacher)
+    bump_version(db, REFERENCE_KEY, commit=False)
     db.commit()
     db.refresh(db_teacher)
     return db_teacher
@@ -31,6 +208,7 @@ def update_teacher(db: Session, teacher_id: int, teacher: schemas.TeacherCreate)
     db_teacher = get_teacher(db, teacher_id)
     if db_teacher:
         db_teacher.name = teacher.name
+        bump_version(db, REFERENCE_KEY, commit=False)
         db.commit()
         db.refresh(db_teacher)
     return db_teacher
@@ -41,6 +219,7 @@ def delete_teacher(db: Session, teacher_id: int) -> bool:
     db_teacher = get_teacher(db, teacher_id)
     if db_teacher:
         db.delete(db_teacher)
+        bump_version(db, REFERENCE_KEY, commit=False)
         db.commit()
         return True
     return False
@@ -51,6 +230,7 @@ def create_course(db: Session, course: schemas.CourseCreate) -> models.Course:
     """建立新課程"""
     db_course = models.Course(name=course.name, course_type=course.course_type)
     db.add(db_course)
+    bump_version(db, REFERENCE_KEY, commit=False)
     db.commit()
     db.refresh(db_course)
     return db_course
@@ -72,6 +252,7 @@ def update_course(db: Session, course_id: int, course: schemas.CourseCreate) ->
     if db_course:
         db_course.name = course.name
         db_course.course_type = course.course_type
+        bump_version(db, REFERENCE_KEY, commit=False)
         db.commit()
         db.refresh(db_course)
     return db_course
@@ -82,28 +263,66 @@ def delete_course(db: Session, course_id: int) -> bool:
     db_course = get_course(db, course_id)
     if db_course:
         db.delete(db_course)
+        bump_version(db, REFERENCE_KEY, commit=False)
         db.commit()
         return True
     return False
 
 
 # ========== Attendance CRUD ==========
-def create_attendance(db: Session, attendance: schemas.AttendanceCreate) -> models.Attendance:
-    """建立上課紀錄（自動計算薪資）"""
+def get_by_idempotency_key(db: Session, model, key: str):
+    """以冪等鍵取得已建立的紀錄 (沒有則回傳 None)"""
+    return db.query(model).filter(model.idempotency_key == key).first()
+
+
+def _insert_idempotent(db: Session, record, kind: str) -> Tuple[object, bool]:
+    """
+    新增紀錄、寫入異動日誌並遞增該月資料版本後提交，回傳 (紀錄, 是否新建立)
+    同一個冪等鍵同時送達而違反唯一索引時 (flush 或 commit 時都可能發生)，
+    回滾並回傳先建立的紀錄 (是否新建立為 False)
+    """
+    try:
+        db.add(record)
+        db.flush()
+        _log_change(db, kind, "create", record.id, record.date)
+        bump_version(db, data_key(record.date.year, record.date.month), commit=False)
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        key = record.idempotency_key
+        existing = get_by_idempotency_key(db, type(record), key) if key else None
+        if existing is None:
+            raise
+        return existing, False
+    db.refresh(record)
+    return record, True
+
+
+def _build_attendance(db: Session, attendance: schemas.AttendanceCreate) -> models.Attendance:
+    """檢查月份並建立上課紀錄物件（自動計算薪資），尚未寫入"""
+    ensure_month_open(db, attendance.date)
+    
     # 自動計算薪資
     calculated_salary = calculate_salary(attendance.student_count)
     
-    db_attendance = models.Attendance(
+    return models.Attendance(
         date=attendance.date,
         teacher_id=attendance.teacher_id,
         course_id=attendance.course_id,
         student_count=attendance.student_count,
-        calculated_salary=calculated_salary
+        calculated_salary=calculated_salary,
+        idempotency_key=attendance.idempotency_key
     )
-    db.add(db_attendance)
-    db.commit()
-    db.refresh(db_attendance)
-    return db_attendance
+
+
+def create_attendance(db: Session, attendance: schemas.AttendanceCreate) -> models.Attendance:
+    """建立上課紀錄（自動計算薪資）；帶冪等鍵且已建立過時直接回傳既有紀錄"""
+    if attendance.idempotency_key:
+        existing = get_by_idempotency_key(db, models.Attendance, attendance.idempotency_key)
+        if existing:
+            return existing
+    record, _ = _insert_idempotent(db, _build_attendance(db, attendance), "attendance")
+    return record
 
 
 def get_attendance(db: Session, attendance_id: int) -> Optional[models.Attendance]:
@@ -111,53 +330,191 @@ def get_attendance(db: Session, attendance_id: int) -> Optional[models.Attendanc
     return db.query(models.Attendance).filter(models.Attendance.id == attendance_id).first()
 
 
-def get_attendances(db: Session, skip: int = 0, limit: int = 100) -> List[models.Attendance]:
-    """取得上課紀錄列表"""
-    return db.query(models.Attendance).offset(skip).limit(limit).all()
+def get_attendances(
+    db: Session,
+    skip: int = 0,
+    limit: int = 100,
+    columns: Optional[list] = None,
+    joins: Optional[list] = None,
+    criteria: tuple = (),
+    order_by: Optional[list] = None
+) -> List[models.Attendance]:
+    """取得上課紀錄列表 (criteria/order_by 來自 resolve_filters/resolve_sort)"""
+    if columns:
+        return _select_rows(db, columns, *criteria, skip=skip, limit=limit, joins=joins, order_by=order_by)
+    return db.query(models.Attendance).filter(*criteria).order_by(*(order_by or ())).offset(skip).limit(limit).all()
 
 
-def get_attendances_by_teacher(db: Session, teacher_id: int) -> List[models.Attendance]:
+def get_attendances_by_teacher(db: Session, teacher_id: int, columns: Optional[list] = None, joins: Optional[list] = None) -> List[models.Attendance]:
     """取得特定教練的上課紀錄"""
+    if columns:
+        return _select_rows(db, columns, models.Attendance.teacher_id == teacher_id, joins=joins)
     return db.query(models.Attendance).filter(models.Attendance.teacher_id == teacher_id).all()
 
 
-def get_attendances_by_date_range(db: Session, start_date: date, end_date: date) -> List[models.Attendance]:
+def get_attendances_by_date_range(db: Session, start_date: date, end_date: date, columns: Optional[list] = None, joins: Optional[list] = None) -> List[models.Attendance]:
     """取得特定日期範圍的上課紀錄"""
-    return db.query(models.Attendance).filter(
+    criteria = (
         models.Attendance.date >= start_date,
         models.Attendance.date <= end_date
-    ).all()
+    )
+    if columns:
+        return _select_rows(db, columns, *criteria, joins=joins)
+    return db.query(models.Attendance).filter(*criteria).all()
 
 
 def delete_attendance(db: Session, attendance_id: int) -> bool:
     """刪除上課紀錄"""
     db_attendance = get_attendance(db, attendance_id)
     if db_attendance:
+        ensure_month_open(db, db_attendance.date)
         db.delete(db_attendance)
+        _log_change(db, "attendance", "delete", attendance_id, db_attendance.date)
+        bump_version(db, data_key(db_attendance.date.year, db_attendance.date.month), commit=False)
         db.commit()
         return True
     return False
 
 
+def recalculate_attendance_salaries(
+    db: Session,
+    start_date: date,
+    end_date: date,
+    tiers: List[dict],
+    chunk_size: int = 5000,
+    progress: Optional[Callable[[int, int], None]] = None
+) -> int:
+    """
+    依指定規則重算期間內所有上課紀錄的 calculated_salary
+    以 CASE 對應級距的單一 UPDATE 處理，依 id 區間分批提交 (不逐筆在 Python 計算)
+    回傳實際被更新的筆數；progress(已處理 id 數, 總 id 數) 可用於回報進度
+    """
+    # CASE 依序比對級距 (第一個符合者勝出)，未符合則使用最後一個級距，與 calculate_salary 一致
+    whens = [
+        (models.Attendance.student_count.between(tier["min"], tier["max"]), float(tier["amount"]))
+        for tier in tiers
+    ]
+    fallback = float(tiers[-1]["amount"]) if tiers else 0.0
+    salary_case = case(*whens, else_=fallback) if whens else fallback
+
+    in_period = (
+        models.Attendance.date >= start_date,
+        models.Attendance.date <= end_date
+    )
+    min_id, max_id = db.query(
+        func.min(models.Attendance.id), func.max(models.Attendance.id)
+    ).filter(*in_period).one()
+    if min_id is None:
+        return 0
+
+    total_span = max_id - min_id + 1
+    updated = 0
+    for lo in range(min_id, max_id + 1, chunk_size):
+        hi = lo + chunk_size
+        in_chunk = (*in_period, models.Attendance.id >= lo, models.Attendance.id < hi)
+        stmt = (
+            update(models.Attendance)
+            .where(
+                *in_chunk,
+                or_(models.Attendance.calculated_salary.is_(None), models.Attendance.calculated_salary != salary_case)
+            )
+            .values(calculated_salary=salary_case)
+            .execution_options(synchronize_session=False)
+        )
+        chunk_updated = db.execute(stmt).rowcount or 0
+        if chunk_updated:
+            # 與這批更新在同一個交易記錄 reset 並遞增版本：中途失敗時已提交的批次也會讓快取/前端重新載入
+            first_date, last_date = db.query(
+                func.min(models.Attendance.date), func.max(models.Attendance.date)
+            ).filter(*in_chunk).one()
+            for year, month in payroll.months_between(first_date, last_date):
+                # 大量更新不逐筆記錄，改記一筆 reset 讓前端整月重新載入
+                _log_change(db, "attendance", "reset", 0, date(year, month, 1))
+                bump_version(db, data_key(year, month), commit=False)
+        db.commit()
+        updated += chunk_updated
+        if progress:
+            progress(min(hi, max_id + 1) - min_id, total_span)
+    return updated
+
+
 # ========== Sales CRUD ==========
-def create_sales(db: Session, sales: schemas.SalesCreate) -> models.Sales:
-    """建立賣課紀錄（自動計算提成）"""
-    # 自動計算提成 (如果前端有傳 commission 則使用，否則嘗試計算)
-    commission = sales.commission if sales.commission is not None and sales.commission > 0 else calculate_commission(sales.plan_type, sales.amount)
+def _build_sales(db: Session, sales: schemas.SalesCreate) -> models.Sales:
+    """檢查月份並建立賣課紀錄物件（自動計算提成與明細），尚未寫入"""
+    ensure_month_open(db, sales.date)
+    
+    # 自動計算提成 (如果前端有傳 commission 則使用，有明細則加總明細，否則嘗試計算)
+    if sales.commission is not None and sales.commission > 0:
+        commission = sales.commission
+    elif sales.items:
+        commission = sum(item.quantity * item.unit_commission for item in sales.items)
+    else:
+        commission = calculate_commission(sales.plan_type, sales.amount)
     
-    db_sales = models.Sales(
+    # 明細：前端未提供時由 plan_type 與金額推算 (與歷史資料回填相同邏輯)
+    if sales.items:
+        items = [item.model_dump() for item in sales.items]
+    else:
+        check_inference_limit(sales.plan_type, sales.amount, sales.custom_amount)
+        items = infer_sale_items(sales.plan_type, sales.amount, sales.custom_amount, commission)
+    
+    # 表頭與明細在同一個交易寫入
+    return models.Sales(
         date=sales.date,
         teacher_id=sales.teacher_id,
         plan_type=sales.plan_type,
         amount=sales.amount,
         commission=commission,
         note=sales.note,
-        custom_amount=sales.custom_amount
+        custom_amount=sales.custom_amount,
+        items=[models.SaleItem(**item) for item in items],
+        idempotency_key=sales.idempotency_key
     )
-    db.add(db_sales)
-    db.commit()
-    db.refresh(db_sales)
-    return db_sales
+
+
+def create_sales(db: Session, sales: schemas.SalesCreate) -> models.Sales:
+    """建立賣課紀錄（自動計算提成）；帶冪等鍵且已建立過時直接回傳既有紀錄"""
+    if sales.idempotency_key:
+        existing = get_by_idempotency_key(db, models.Sales, sales.idempotency_key)
+        if existing:
+            return existing
+    record, _ = _insert_idempotent(db, _build_sales(db, sales), "sales")
+    return record
+
+
+# 批次送出的紀錄類型：kind -> (資料表, 建立用 schema, 建立紀錄物件的函數)
+SUBMISSION_TARGETS = {
+    "attendance": (models.Attendance, schemas.AttendanceCreate, _build_attendance),
+    "sales": (models.Sales, schemas.SalesCreate, _build_sales),
+}
+
+
+def apply_submission(db: Session, item: schemas.SubmissionItem) -> dict:
+    """
+    處理批次送出的一筆紀錄 (各自一個交易，單筆失敗不影響其他筆)
+    資料有誤 (驗證失敗、ValueError) 或月份已關帳回傳 rejected，重送也不會成功；
+    其餘例外往上拋 (500)，由前端逐筆重送找出問題項目
+    """
+    model, schema, build = SUBMISSION_TARGETS[item.kind]
+    result = {"idempotency_key": item.idempotency_key}
+    existing = get_by_idempotency_key(db, model, item.idempotency_key)
+    if existing:
+        return {**result, "status": "duplicate", "id": existing.id}
+    try:
+        record = build(db, schema.model_validate({**item.data, "idempotency_key": item.idempotency_key}))
+        # 同一個冪等鍵同時送達時，由 _insert_idempotent 回傳先建立的紀錄
+        record, created = _insert_idempotent(db, record, item.kind)
+    except ValidationError as e:
+        detail = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+        return {**result, "status": "rejected", "detail": detail}
+    except (MonthClosedError, ValueError) as e:
+        # 例如已關帳、上課人數 0 (calculate_salary)、金額超出明細推算範圍
+        db.rollback()
+        return {**result, "status": "rejected", "detail": str(e)}
+    except IntegrityError as e:
+        db.rollback()
+        return {**result, "status": "rejected", "detail": str(e.orig)}
+    return {**result, "status": "created" if created else "duplicate", "id": record.id}
 
 
 def get_sales(db: Session, sales_id: int) -> Optional[models.Sales]:
@@ -165,34 +522,260 @@ def get_sales(db: Session, sales_id: int) -> Optional[models.Sales]:
     return db.query(models.Sales).filter(models.Sales.id == sales_id).first()
 
 
-def get_all_sales(db: Session, skip: int = 0, limit: int = 100) -> List[models.Sales]:
-    """取得賣課紀錄列表"""
-    return db.query(models.Sales).offset(skip).limit(limit).all()
+def get_all_sales(
+    db: Session,
+    skip: int = 0,
+    limit: int = 100,
+    columns: Optional[list] = None,
+    joins: Optional[list] = None,
+    criteria: tuple = (),
+    order_by: Optional[list] = None
+) -> List[models.Sales]:
+    """取得賣課紀錄列表 (criteria/order_by 來自 resolve_filters/resolve_sort)"""
+    if columns:
+        return _select_rows(db, columns, *criteria, skip=skip, limit=limit, joins=joins, order_by=order_by)
+    return db.query(models.Sales).filter(*criteria).order_by(*(order_by or ())).offset(skip).limit(limit).all()
 
 
-def get_sales_by_teacher(db: Session, teacher_id: int) -> List[models.Sales]:
+def get_sales_by_teacher(db: Session, teacher_id: int, columns: Optional[list] = None, joins: Optional[list] = None) -> List[models.Sales]:
     """取得特定教練的賣課紀錄"""
+    if columns:
+        return _select_rows(db, columns, models.Sales.teacher_id == teacher_id, joins=joins)
     return db.query(models.Sales).filter(models.Sales.teacher_id == teacher_id).all()
 
 
-def get_sales_by_date_range(db: Session, start_date: date, end_date: date) -> List[models.Sales]:
+def get_sales_by_date_range(db: Session, start_date: date, end_date: date, columns: Optional[list] = None, joins: Optional[list] = None) -> List[models.Sales]:
     """取得特定日期範圍的賣課紀錄"""
-    return db.query(models.Sales).filter(
+    criteria = (
         models.Sales.date >= start_date,
         models.Sales.date <= end_date
-    ).all()
+    )
+    if columns:
+        return _select_rows(db, columns, *criteria, joins=joins)
+    return db.query(models.Sales).filter(*criteria).all()
 
 
 def delete_sales(db: Session, sales_id: int) -> bool:
     """刪除賣課紀錄"""
     db_sales = get_sales(db, sales_id)
     if db_sales:
+        ensure_month_open(db, db_sales.date)
         db.delete(db_sales)
+        _log_change(db, "sales", "delete", sales_id, db_sales.date)
+        bump_version(db, data_key(db_sales.date.year, db_sales.date.month), commit=False)
         db.commit()
         return True
     return False
 
 
+def get_plan_sales_report(db: Session, start_date: date, end_date: date) -> list:
+    """依方案彙總期間內的售出數量、營收與提成 (sale_items GROUP BY plan)"""
+    stmt = select(
+        models.SaleItem.plan,
+        func.sum(models.SaleItem.quantity).label("quantity"),
+        func.sum(models.SaleItem.quantity * models.SaleItem.unit_price).label("revenue"),
+        func.sum(models.SaleItem.quantity * models.SaleItem.unit_commission).label("commission")
+    ).join(models.Sales, models.Sales.id == models.SaleItem.sales_id).where(
+        models.Sales.date >= start_date,
+        models.Sales.date <= end_date
+    ).group_by(models.SaleItem.plan).order_by(models.SaleItem.plan)
+    return db.execute(stmt).all()
+
+
+# ========== Month Sync ==========
+def get_latest_change_seq(db: Session) -> int:
+    """目前最新的異動序號 (尚無異動為 0)"""
+    return db.query(func.coalesce(func.max(models.RecordChange.seq), 0)).scalar()
+
+
+# 同步游標：序號在交易提交前就已配置，PostgreSQL 並行寫入時較小的序號可能較晚才提交
+CHANGE_GAP_GRACE_SECONDS = 60  # 等待被跳過的序號提交的時間，逾時視為交易已回滾
+CHANGE_GAP_SCAN = 1000  # 檢查缺口時最多往回看的異動數
+
+
+def get_sync_change_seq(db: Session, since: int = 0) -> int:
+    """
+    可安全作為增量同步游標的異動序號
+    直接用 max(seq) 會讓之後才提交的較小序號永遠被跳過；這裡停在最近一個缺口之前，
+    缺口補上後下一次同步就會包含它。缺口之後的異動寫入已超過 CHANGE_GAP_GRACE_SECONDS
+    時視為該交易已回滾，不再等待
+    """
+    rows = db.query(models.RecordChange.seq, models.RecordChange.created_at).filter(
+        models.RecordChange.seq > since
+    ).order_by(models.RecordChange.seq.desc()).limit(CHANGE_GAP_SCAN).all()
+    if not rows:
+        return since
+    rows.reverse()
+    # 超過掃描範圍時，更早的缺口視為已過期
+    expected = since + 1 if len(rows) < CHANGE_GAP_SCAN else rows[0].seq
+    cutoff = datetime.now() - timedelta(seconds=CHANGE_GAP_GRACE_SECONDS)
+    for seq, created_at in rows:
+        if seq != expected and created_at >= cutoff:
+            return expected - 1
+        expected = seq + 1
+    return rows[-1].seq
+
+
+def get_month_changes(db: Session, start_date: date, end_date: date, since: int, until: int) -> List[models.RecordChange]:
+    """取得某期間內 since < seq <= until 的異動"""
+    return db.query(models.RecordChange).filter(
+        models.RecordChange.seq > since,
+        models.RecordChange.seq <= until,
+        models.RecordChange.record_date >= start_date,
+        models.RecordChange.record_date <= end_date
+    ).order_by(models.RecordChange.seq).all()
+
+
+def get_rows_by_ids(db: Session, model, columns: list, ids: List[int]) -> list:
+    """依 id 取得指定欄位 (增量同步只取新增的紀錄)"""
+    if not ids:
+        return []
+    return _select_rows(db, columns, model.id.in_(ids), order_by=[model.id])
+
+
+# 即時事件中新增紀錄附帶的欄位：kind -> (資料表, 欄位)
+EVENT_DATA_COLUMNS = {
+    "attendance": (models.Attendance, ["teacher_id", "course_id", "student_count", "calculated_salary"]),
+    "sales": (models.Sales, ["teacher_id", "plan_type", "amount", "commission"]),
+}
+
+
+def get_change_events(db: Session, since: int, limit: int, include_ids: Sequence[int] = ()) -> List[dict]:
+    """
+    將 seq > since 的異動轉為即時事件 (id 即 seq，依序排列)
+    include_ids 為 since 以下仍在等待的序號 (晚提交的交易)，出現時一併回傳
+    新增事件附上紀錄目前的欄位；之後已被刪除的紀錄不附 data，後面會有它的刪除事件
+    """
+    criteria = models.RecordChange.seq > since
+    if include_ids:
+        criteria = or_(criteria, models.RecordChange.seq.in_(include_ids))
+    changes = db.query(models.RecordChange).filter(criteria).order_by(models.RecordChange.seq).limit(limit).all()
+    data = {}
+    for kind, (model, names) in EVENT_DATA_COLUMNS.items():
+        ids = [change.record_id for change in changes if change.kind == kind and change.op == "create"]
+        columns = [model.id] + [getattr(model, name) for name in names]
+        data[kind] = {row[0]: dict(zip(names, row[1:])) for row in get_rows_by_ids(db, model, columns, ids)}
+    events = []
+    for change in changes:
+        event = {
+            "id": change.seq,
+            "kind": change.kind,
+            "op": change.op,
+            "record_id": change.record_id,
+            "date": change.record_date.isoformat()
+        }
+        if change.record_id in data.get(change.kind, {}):
+            event["data"] = data[change.kind][change.record_id]
+        events.append(event)
+    return events
+
+
+# ========== Teacher Earnings ==========
+def get_teacher_earnings(db: Session, teacher_id: int, start_date: date, end_date: date, skip: int = 0, limit: int = 100) -> dict:
+    """
+    教練個人期間明細 (依日期排序) 與當月累計
+    上課/賣課以 UNION ALL 合併，當月累計以視窗函數 (依月份分割) 在資料庫算出，
+    分頁直接下推為 OFFSET/LIMIT，只回傳這一頁的明細；期間合計另以單一彙總查詢取得
+    起日不是 1 號時，視窗仍從該月 1 號開始累計，再篩掉起日之前的明細
+    """
+    attendance_criteria = (
+        models.Attendance.teacher_id == teacher_id,
+        models.Attendance.date >= start_date,
+        models.Attendance.date <= end_date
+    )
+    sales_criteria = (
+        models.Sales.teacher_id == teacher_id,
+        models.Sales.date >= start_date,
+        models.Sales.date <= end_date
+    )
+    # 當月累計須從起日所在月份的 1 號算起
+    window_start = start_date.replace(day=1)
+    # 同一天先列上課再列賣課
+    attendance_lines = select(
+        models.Attendance.date.label("date"),
+        literal_column("0", Integer).label("kind_order"),
+        models.Attendance.id.label("record_id"),
+        literal_column("'attendance'", String).label("kind"),
+        func.coalesce(models.Course.name, "未知課程").label("description"),
+        models.Attendance.student_count.label("student_count"),
+        func.coalesce(models.Attendance.calculated_salary, 0.0).label("base"),
+        literal_column("0.0", Float).label("commission")
+    ).outerjoin(models.Course, models.Attendance.course_id == models.Course.id).where(
+        models.Attendance.teacher_id == teacher_id,
+        models.Attendance.date >= window_start,
+        models.Attendance.date <= end_date
+    )
+    sales_lines = select(
+        models.Sales.date,
+        literal_column("1", Integer),
+        models.Sales.id,
+        literal_column("'sales'", String),
+        models.Sales.plan_type,
+        cast(null(), Integer),
+        literal_column("0.0", Float),
+        func.coalesce(models.Sales.commission, 0.0)
+    ).where(
+        models.Sales.teacher_id == teacher_id,
+        models.Sales.date >= window_start,
+        models.Sales.date <= end_date
+    )
+    lines = union_all(attendance_lines, sales_lines).subquery()
+
+    month_to_date = {
+        "partition_by": reports.date_bucket("month", lines.c.date, db.get_bind().dialect.name),
+        "order_by": (lines.c.date, lines.c.kind_order, lines.c.record_id),
+        "rows": (None, 0)
+    }
+    running = select(
+        lines.c.date,
+        lines.c.kind_order,
+        lines.c.kind,
+        lines.c.record_id,
+        lines.c.description,
+        lines.c.student_count,
+        lines.c.base,
+        lines.c.commission,
+        func.sum(lines.c.base).over(**month_to_date).label("mtd_base"),
+        func.sum(lines.c.commission).over(**month_to_date).label("mtd_commission")
+    ).subquery()
+    # 視窗算完後才篩掉起日之前的明細，累計不受影響
+    page = db.execute(
+        select(
+            running.c.date,
+            running.c.kind,
+            running.c.record_id,
+            running.c.description,
+            running.c.student_count,
+            running.c.base,
+            running.c.commission,
+            running.c.mtd_base,
+            running.c.mtd_commission
+        ).where(running.c.date >= start_date)
+        .order_by(running.c.date, running.c.kind_order, running.c.record_id)
+        .offset(skip).limit(limit)
+    ).all()
+    items = [
+        {**row._mapping, "mtd_total": row.mtd_base + row.mtd_commission}
+        for row in page
+    ]
+
+    base_total, attendance_count = db.execute(
+        select(func.coalesce(func.sum(models.Attendance.calculated_salary), 0.0), func.count(models.Attendance.id)).where(*attendance_criteria)
+    ).one()
+    commission_total, sales_count = db.execute(
+        select(func.coalesce(func.sum(models.Sales.commission), 0.0), func.count(models.Sales.id)).where(*sales_criteria)
+    ).one()
+    return {
+        "base": float(base_total),
+        "commission": float(commission_total),
+        "total": float(base_total) + float(commission_total),
+        "total_items": attendance_count + sales_count,
+        "skip": skip,
+        "limit": limit,
+        "items": items
+    }
+
+
 # ========== Monthly Salary Rule CRUD ==========
 def get_monthly_salary_rule(db: Session, year: int, month: int) -> Optional[models.MonthlySalaryRule]:
     """取得特定月份的薪資規則快照"""
@@ -204,7 +787,6 @@ def get_monthly_salary_rule(db: Session, year: int, month: int) -> Optional[mode
 
 def upsert_monthly_salary_rule(db: Session, year: int, month: int, rules_data: List[dict]):
     """新增或更新特定月份的薪資規則快照"""
-    import json
     rules_json = json.dumps(rules_data, ensure_ascii=False)
     
     db_rule = get_monthly_salary_rule(db, year, month)
@@ -217,3 +799,106 @@ def upsert_monthly_salary_rule(db: Session, year: int, month: int, rules_data: L
     db.commit()
     db.refresh(db_rule)
     return db_rule
+
+
+def get_rules_for_month(db: Session, year: int, month: int) -> List[dict]:
+    """取得特定月份適用的薪資規則 (若該月無快照，則回傳目前規則)"""
+    db_rule = get_monthly_salary_rule(db, year, month)
+    if db_rule:
+        return json.loads(db_rule.rules_json)
+    return load_rules()
+
+
+def get_rules_in_force(db: Session, year: int, month: int) -> List[dict]:
+    """取得特定月份實際適用的規則 (已關帳月份以關帳時的規則為準)"""
+    db_close = get_payroll_close(db, year, month)
+    if db_close:
+        return json.loads(db_close.rules_json)
+    return get_rules_for_month(db, year, month)
+
+
+# ========== Monthly Payroll Close CRUD ==========
+def get_payroll_close(db: Session, year: int, month: int) -> Optional[models.MonthlyPayrollClose]:
+    """取得特定月份的關帳紀錄"""
+    return db.query(models.MonthlyPayrollClose).filter(
+        models.MonthlyPayrollClose.year == year,
+        models.MonthlyPayrollClose.month == month
+    ).first()
+
+
+def get_closed_payroll(db: Session, year: int, month: int) -> List[models.MonthlyPayroll]:
+    """取得特定月份凍結的薪資結果"""
+    return db.query(models.MonthlyPayroll).filter(
+        models.MonthlyPayroll.year == year,
+        models.MonthlyPayroll.month == month
+    ).order_by(models.MonthlyPayroll.total.desc()).all()
+
+
+def get_closed_payrolls(db: Session, months: List[tuple]) -> dict:
+    """取得多個月份中已關帳月份的凍結結果：{(年, 月): [MonthlyPayroll]}"""
+    wanted = set(months)
+    years = {year for year, _ in wanted}
+    closed = {
+        (close.year, close.month)
+        for close in db.query(models.MonthlyPayrollClose.year, models.MonthlyPayrollClose.month)
+        .filter(models.MonthlyPayrollClose.year.in_(years)).all()
+        if (close.year, close.month) in wanted
+    }
+    frozen = {key: [] for key in closed}
+    if closed:
+        for row in db.query(models.MonthlyPayroll).filter(models.MonthlyPayroll.year.in_(years)).all():
+            if (row.year, row.month) in frozen:
+                frozen[(row.year, row.month)].append(row)
+    return frozen
+
+
+def ensure_month_open(db: Session, record_date: date):
+    """檢查紀錄日期所屬月份是否已關帳，已關帳則拋出 MonthClosedError"""
+    if get_payroll_close(db, record_date.year, record_date.month):
+        raise MonthClosedError(record_date.year, record_date.month)
+
+
+def close_month(db: Session, year: int, month: int) -> models.MonthlyPayrollClose:
+    """
+    月結關帳：以該月規則計算一次薪資並凍結每位教練的結果
+    (重複呼叫即為重新關帳，會覆蓋舊的凍結結果)
+    """
+    tiers = get_rules_for_month(db, year, month)
+    results, content_hash = payroll.compute_month_payroll(db, year, month, tiers)
+    
+    db.query(models.MonthlyPayroll).filter(
+        models.MonthlyPayroll.year == year,
+        models.MonthlyPayroll.month == month
+    ).delete(synchronize_session=False)
+    
+    for row in results:
+        db.add(models.MonthlyPayroll(year=year, month=month, **row))
+    
+    db_close = get_payroll_close(db, year, month)
+    if db_close is None:
+        db_close = models.MonthlyPayrollClose(year=year, month=month)
+        db.add(db_close)
+    db_close.rules_json = json.dumps(tiers, ensure_ascii=False)
+    db_close.content_hash = content_hash
+    db_close.closed_at = datetime.now()
+    # 標記該月已關帳 (報表快取改為固定保存)
+    set_setting(db, data_key(year, month), {"closed": True}, commit=False)
+    
+    db.commit()
+    db.refresh(db_close)
+    return db_close
+
+
+def reopen_month(db: Session, year: int, month: int) -> bool:
+    """重新開帳：刪除該月的關帳紀錄與凍結結果"""
+    db_close = get_payroll_close(db, year, month)
+    if not db_close:
+        return False
+    db.query(models.MonthlyPayroll).filter(
+        models.MonthlyPayroll.year == year,
+        models.MonthlyPayroll.month == month
+    ).delete(synchronize_session=False)
+    db.delete(db_close)
+    set_setting(db, data_key(year, month), {"closed": False}, commit=False)
+    db.commit()
+    return True
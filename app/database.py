@@ -1,4 +1,9 @@
-from sqlalchemy import create_engine
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from decouple import config
@@ -7,23 +12,39 @@ from decouple import config
 # 本地開發則使用 SQLite
 SQLALCHEMY_DATABASE_URL = config('DATABASE_URL', default='sqlite:///./dexsystem.db')
 
-# 根據資料庫類型設定不同的 connect_args
-if SQLALCHEMY_DATABASE_URL.startswith('sqlite'):
-    # SQLite 需要 check_same_thread
-    engine = create_engine(
-        SQLALCHEMY_DATABASE_URL,
-        connect_args={"check_same_thread": False}
-    )
-else:
+# 選用：唯讀副本 (read replica)，報表/匯出/列表查詢走這裡，減輕主庫負擔
+# 本地測試可指向另一個 SQLite 檔或另一個 PostgreSQL
+SQLALCHEMY_READ_DATABASE_URL = config('DATABASE_READ_URL', default='')
+
+# 副本延遲超過此秒數時改回主庫讀取
+REPLICA_MAX_LAG_SECONDS = config('REPLICA_MAX_LAG_SECONDS', default=5.0, cast=float)
+# 副本延遲檢查間隔 (秒)，避免每個請求都查詢
+REPLICA_LAG_CHECK_SECONDS = config('REPLICA_LAG_CHECK_SECONDS', default=5.0, cast=float)
+
+
+def _create_engine(url: str):
+    # 根據資料庫類型設定不同的 connect_args
+    if url.startswith('sqlite'):
+        # SQLite 需要 check_same_thread
+        return create_engine(
+            url,
+            connect_args={"check_same_thread": False}
+        )
     # PostgreSQL 不需要 check_same_thread
-    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    return create_engine(url)
+
+
+engine = _create_engine(SQLALCHEMY_DATABASE_URL)
+read_engine = _create_engine(SQLALCHEMY_READ_DATABASE_URL) if SQLALCHEMY_READ_DATABASE_URL else None
 
 # 建立 Session
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine) if read_engine else None
 
 # 宣告 Base 類別
 Base = declarative_base()
 
+
 # 取得資料庫 session 的依賴函數
 def get_db():
     db = SessionLocal()
@@ -31,3 +52,57 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# ========== Read Replica ==========
+_replica_lock = threading.Lock()
+_replica_state = {"fresh": False, "lag": None, "checked_at": 0.0}
+
+
+def replica_lag_seconds() -> Optional[float]:
+    """查詢副本延遲秒數 (無法連線回傳 None)"""
+    if read_engine is None:
+        return None
+    try:
+        with read_engine.connect() as conn:
+            if read_engine.dialect.name == "postgresql":
+                # 已重播到最新 WAL 視為無延遲；否則以最後重播交易時間估算
+                lag = conn.execute(text(
+                    "SELECT CASE "
+                    "WHEN NOT pg_is_in_recovery() THEN 0 "
+                    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+                )).scalar()
+                return float(lag)
+            # SQLite 等無複寫機制的副本：可連線即視為無延遲
+            conn.execute(text("SELECT 1"))
+            return 0.0
+    except SQLAlchemyError:
+        return None
+
+
+def replica_is_fresh() -> bool:
+    """副本是否可用且延遲在門檻內 (結果快取 REPLICA_LAG_CHECK_SECONDS 秒)"""
+    if read_engine is None:
+        return False
+    with _replica_lock:
+        now = time.monotonic()
+        if now - _replica_state["checked_at"] >= REPLICA_LAG_CHECK_SECONDS:
+            lag = replica_lag_seconds()
+            _replica_state["lag"] = lag
+            _replica_state["fresh"] = lag is not None and lag <= REPLICA_MAX_LAG_SECONDS
+            _replica_state["checked_at"] = now
+        return _replica_state["fresh"]
+
+
+def get_read_db():
+    """
+    報表/匯出/列表用的 session
+    有設定副本且延遲在門檻內時讀副本，否則回主庫 (寫入與寫後讀一律使用 get_db)
+    """
+    factory = ReadSessionLocal if replica_is_fresh() else SessionLocal
+    db = factory()
+    try:
+        yield db
+    finally:
+        db.close()
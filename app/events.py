@@ -0,0 +1,187 @@
+"""
+即時事件廣播模組
+========================
+上課/賣課紀錄的新增/刪除都與紀錄本身在同一個交易寫入 record_changes 異動日誌，
+每個 worker 由背景工作輪詢日誌，把新的異動轉成精簡事件，
+透過 Server-Sent Events (SSE) 推送給連到本 worker 的訂閱者。
+
+- 事件 id 即異動序號 (seq)：不論寫入發生在哪個 worker，所有訂閱者看到相同的 id 與順序
+- 斷線重連時依 Last-Event-ID 從異動日誌補送，重連到其他 worker 也一樣
+- 序號依配置順序而非提交順序 (PostgreSQL 並行寫入時較小的序號可能較晚提交)：
+  輪詢時記下跳過的序號，之後出現再補送 (id 可能小於已送出的事件)，逾時視為已回滾；
+  重連補送也從 Last-Event-ID 往回多掃一段
+- 每個訂閱者有固定長度的佇列，消費太慢而滿出時清空佇列改送 reset，
+  客戶端收到 reset 應整批重新載入，不會默默漏掉事件
+- 沒有訂閱者時不輪詢資料庫
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Set
+
+SUBSCRIBER_QUEUE_SIZE = 1000  # 每個訂閱者最多暫存的事件數 (須容納一次完整補送)
+REPLAY_LIMIT = 500  # 重連時最多補送的事件數 (超過則改送 reset，由客戶端整批重新載入)
+REPLAY_RESCAN = 50  # 重連補送時從 Last-Event-ID 往回多掃的序號數 (涵蓋斷線期間才提交的較小序號)
+EVENT_POLL_SECONDS = 1.0  # 輪詢異動日誌的間隔
+EVENT_BATCH_SIZE = 500  # 每次輪詢最多讀取的異動數
+GAP_GRACE_SECONDS = 30.0  # 等待被跳過的序號提交的時間，逾時視為交易已回滾
+MAX_TRACKED_GAPS = 1000  # 一次跳過太多序號時不逐一追蹤，改送 reset
+
+logger = logging.getLogger("dexsystem")
+
+# load_changes(since, limit, include_ids) -> seq 大於 since 或在 include_ids 內的事件 (依 seq 排序)
+# latest_seq() -> 目前最新序號
+ChangeLoader = Callable[[int, int, Sequence[int]], List[Dict]]
+SeqLoader = Callable[[], int]
+
+
+def reset_event(seq: int) -> Dict:
+    """要求客戶端整批重新載入的事件"""
+    return {"id": seq, "kind": "all", "op": "reset"}
+
+
+class Subscriber:
+    """單一 SSE 連線的事件佇列 (只在 event loop 內操作)"""
+
+    def __init__(self, maxsize: int, start_id: int, replay_from: Optional[int] = None):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.start_id = start_id  # 訂閱起點 (之後的事件都會送出)
+        # 已送到的最大序號；補送時從 replay_from 開始，讓往回多掃的事件也能送出
+        self.last_id = start_id if replay_from is None else replay_from
+        # 補送期間收到的即時事件先暫存，補送完再依序放入，避免順序錯亂
+        self._pending: Optional[List[tuple]] = [] if replay_from is not None else None
+
+    def push(self, event: Dict, late: bool = False):
+        """late=True 為晚提交的較小序號，即使小於已送出的序號也要送"""
+        if self._pending is not None:
+            self._pending.append((event, late))
+            return
+        if event["id"] <= self.last_id and not late:
+            return  # 補送與即時事件重疊的部分
+        if self.queue.full():
+            # 佇列已滿：清空並改送 reset，由客戶端整批重新載入
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.dropped += 1
+            event = reset_event(max(self.last_id, event["id"]))
+        self.queue.put_nowait(event)
+        self.last_id = max(self.last_id, event["id"])
+
+    def finish_replay(self, backlog: List[Dict]):
+        pending, self._pending = self._pending or [], None
+        for event in backlog:
+            self.push(event)
+        for event, late in pending:
+            self.push(event, late)
+
+
+class EventBroker:
+    """以異動日誌為來源的事件廣播 (每個 worker 一個，start() 在 lifespan 內呼叫)"""
+
+    def __init__(
+        self,
+        queue_size: int = SUBSCRIBER_QUEUE_SIZE,
+        poll_seconds: float = EVENT_POLL_SECONDS,
+        batch_size: int = EVENT_BATCH_SIZE
+    ):
+        self._subscribers: Set[Subscriber] = set()
+        self._queue_size = queue_size
+        self.poll_seconds = poll_seconds
+        self.batch_size = batch_size
+        self._seq: Optional[int] = None  # 已廣播到的異動序號 (沒有訂閱者時為 None)
+        self._gaps: Dict[int, float] = {}  # 被跳過、等待提交的序號 -> 發現時間
+        self._load_changes: Optional[ChangeLoader] = None
+        self._latest_seq: Optional[SeqLoader] = None
+
+    def start(self, load_changes: ChangeLoader, latest_seq: SeqLoader) -> asyncio.Task:
+        """設定異動日誌來源並啟動輪詢 (須在 event loop 內呼叫)"""
+        self._load_changes = load_changes
+        self._latest_seq = latest_seq
+        return asyncio.create_task(self._run())
+
+    async def _run(self):
+        """輪詢異動日誌並廣播給本 worker 的訂閱者 (資料庫查詢在 threadpool 執行)"""
+        load_changes = self._load_changes
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            if not self._subscribers:
+                self._seq = None
+                self._gaps.clear()
+                continue
+            expired = time.monotonic() - GAP_GRACE_SECONDS
+            self._gaps = {seq: seen for seq, seen in self._gaps.items() if seen > expired}
+            try:
+                events = await asyncio.to_thread(load_changes, self._seq, self.batch_size, tuple(self._gaps))
+            except Exception:
+                logger.exception("讀取異動日誌失敗")
+                continue
+            for event in events:
+                self._advance(event)
+
+    def _advance(self, event: Dict):
+        """依序號廣播一個事件，並記下中間被跳過的序號"""
+        seq = event["id"]
+        if self._gaps.pop(seq, None) is not None:
+            self.publish(event, late=True)
+            return
+        if seq <= self._seq:
+            return
+        skipped = seq - self._seq - 1
+        if skipped > MAX_TRACKED_GAPS:
+            logger.warning("異動序號跳過 %d 個，改送 reset", skipped)
+            self.publish(reset_event(seq))
+        elif skipped:
+            now = time.monotonic()
+            self._gaps.update((missing, now) for missing in range(self._seq + 1, seq))
+        self._seq = seq
+        self.publish(event)
+
+    def publish(self, event: Dict, late: bool = False):
+        for sub in list(self._subscribers):
+            sub.push(event, late)
+
+    async def subscribe(self, last_event_id: Optional[int] = None) -> Subscriber:
+        """
+        建立訂閱；有 last_event_id 時先從異動日誌補送之後的事件 (往回多掃 REPLAY_RESCAN 個序號)
+        補送超過 REPLAY_LIMIT 筆時改送一個 reset 事件，客戶端應整批重新載入
+        """
+        if self._latest_seq is None:
+            raise RuntimeError("事件廣播尚未啟動")
+        if self._seq is None:
+            self._seq = await asyncio.to_thread(self._latest_seq)
+        if last_event_id is None:
+            sub = Subscriber(self._queue_size, self._seq)
+            self._subscribers.add(sub)
+            return sub
+        replay_from = max(0, last_event_id - REPLAY_RESCAN)
+        sub = Subscriber(self._queue_size, last_event_id, replay_from)
+        # 先登記再補送：補送期間廣播的事件暫存在 sub，不會遺漏
+        self._subscribers.add(sub)
+        try:
+            backlog = await asyncio.to_thread(self._load_changes, replay_from, REPLAY_LIMIT + 1, ())
+            if len(backlog) > REPLAY_LIMIT:
+                latest = await asyncio.to_thread(self._latest_seq)
+                backlog = [reset_event(latest)]
+        except BaseException:
+            self.unsubscribe(sub)
+            raise
+        sub.finish_replay(backlog)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        self._subscribers.discard(sub)
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+
+def format_sse(event: Dict) -> str:
+    """轉為 SSE 訊息格式"""
+    data = json.dumps(event, ensure_ascii=False, separators=(",", ":"))
+    return f"id: {event['id']}\nevent: {event['kind']}\ndata: {data}\n\n"
+
+
+broker = EventBroker()
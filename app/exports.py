@@ -0,0 +1,137 @@
+"""
+Excel 匯出模組
+========================
+以 XlsxWriter 的 constant_memory 模式產生 xlsx：每寫完一列即寫入暫存檔，
+明細以 yield_per 分批讀取，匯出大範圍資料時記憶體用量固定。
+工作表：薪資總表 (教練 × 月份)、上課明細、賣課明細。
+產生的暫存檔以 FileResponse 分段串流給客戶端，回應結束後由背景工作 remove_file 刪除。
+"""
+import os
+import tempfile
+from datetime import date
+from typing import Dict
+
+import xlsxwriter
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from . import models
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+EXPORT_BATCH_SIZE = 1000  # 明細每批讀取筆數
+
+
+def _write_payroll_sheet(workbook, formats: Dict, payroll_range: Dict):
+    """薪資總表：每位教練一列，各月份總薪資 + 期間上課薪資/提成/總薪資"""
+    sheet = workbook.add_worksheet("薪資總表")
+    month_labels = [
+        f"{m['year']}-{m['month']:02d}{' (已關帳)' if m['closed'] else ''}" for m in payroll_range["months"]
+    ]
+    headers = ["教練姓名", *month_labels, "上課薪資", "銷售提成", "總薪資"]
+    sheet.set_column(0, 0, 14)
+    sheet.set_column(1, len(headers) - 1, 14, formats["money"])
+    sheet.freeze_panes(1, 1)
+    sheet.write_row(0, 0, headers, formats["header"])
+
+    row_index = 1
+    for row in payroll_range["rows"]:
+        sheet.write_string(row_index, 0, row["teacher_name"])
+        sheet.write_row(row_index, 1, [cell["total"] for cell in row["months"]] + [row["base_salary"], row["commission"], row["total"]])
+        row_index += 1
+    total = payroll_range["total"]
+    sheet.write_string(row_index, 0, "合計", formats["header"])
+    sheet.write_row(row_index, 1, [cell["total"] for cell in payroll_range["totals"]] + [total["base_salary"], total["commission"], total["total"]], formats["money_bold"])
+
+
+def _write_detail_sheet(workbook, formats: Dict, name: str, headers: list, widths: list, rows, money_columns: set):
+    """明細工作表：逐列寫入 (constant_memory 下寫過的列即落地，不保留在記憶體)"""
+    sheet = workbook.add_worksheet(name)
+    for column, width in enumerate(widths):
+        sheet.set_column(column, column, width, formats["money"] if column in money_columns else None)
+    sheet.freeze_panes(1, 0)
+    sheet.write_row(0, 0, headers, formats["header"])
+    for row_index, row in enumerate(rows, start=1):
+        sheet.write_datetime(row_index, 0, row[0], formats["date"])
+        for column, value in enumerate(row[1:], start=1):
+            # 文字一律寫成字串，避免備註等內容被當成公式
+            if isinstance(value, str):
+                sheet.write_string(row_index, column, value)
+            elif value is not None:
+                sheet.write_number(row_index, column, value)
+
+
+def write_payroll_workbook(path: str, db: Session, payroll_range: Dict, start_date: date, end_date: date):
+    """寫入期間薪資活頁簿 (payroll_range 為 payroll.compute_range_payroll 的結果)"""
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    formats = {
+        "header": workbook.add_format({"bold": True, "bg_color": "#EEEEEE", "border": 1}),
+        "money": workbook.add_format({"num_format": "#,##0"}),
+        "money_bold": workbook.add_format({"num_format": "#,##0", "bold": True}),
+        "date": workbook.add_format({"num_format": "yyyy-mm-dd"}),
+    }
+    try:
+        _write_payroll_sheet(workbook, formats, payroll_range)
+
+        attendances = db.execute(
+            select(
+                models.Attendance.date,
+                models.Teacher.name,
+                models.Course.name,
+                models.Course.course_type,
+                models.Attendance.student_count,
+                models.Attendance.calculated_salary
+            )
+            .outerjoin(models.Teacher, models.Attendance.teacher_id == models.Teacher.id)
+            .outerjoin(models.Course, models.Attendance.course_id == models.Course.id)
+            .where(models.Attendance.date >= start_date, models.Attendance.date <= end_date)
+            .order_by(models.Attendance.date, models.Attendance.id)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        _write_detail_sheet(
+            workbook, formats, "上課明細",
+            ["日期", "教練姓名", "課程名稱", "課程類型", "上課人數", "薪資"],
+            [12, 14, 20, 10, 10, 12], attendances, money_columns={5}
+        )
+
+        sales = db.execute(
+            select(
+                models.Sales.date,
+                models.Teacher.name,
+                models.Sales.plan_type,
+                models.Sales.amount,
+                models.Sales.custom_amount,
+                models.Sales.commission,
+                models.Sales.note
+            )
+            .outerjoin(models.Teacher, models.Sales.teacher_id == models.Teacher.id)
+            .where(models.Sales.date >= start_date, models.Sales.date <= end_date)
+            .order_by(models.Sales.date, models.Sales.id)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        _write_detail_sheet(
+            workbook, formats, "賣課明細",
+            ["日期", "教練姓名", "方案", "金額", "自訂金額", "提成", "備註"],
+            [12, 14, 24, 12, 12, 12, 30], sales, money_columns={3, 4, 5}
+        )
+    finally:
+        workbook.close()
+
+
+def export_payroll_workbook(db: Session, payroll_range: Dict, start_date: date, end_date: date) -> str:
+    """產生期間薪資活頁簿到暫存檔並回傳路徑 (回應結束後以 remove_file 刪除)"""
+    fd, path = tempfile.mkstemp(prefix="dex_export_", suffix=".xlsx")
+    os.close(fd)
+    try:
+        write_payroll_workbook(path, db, payroll_range, start_date, end_date)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+def remove_file(path: str):
+    """刪除匯出暫存檔 (作為回應的 BackgroundTask，不論內容是否傳送完畢都會執行)"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -1,25 +1,140 @@
-from fastapi import FastAPI, Depends, HTTPException, Query
+import asyncio
+import hashlib
+import json
+import logging
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from sqlalchemy.orm import Session
-from typing import List
-from datetime import date
-
-from datetime import date
-from sqlalchemy import func, extract
+from starlette.background import BackgroundTask
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
+from typing import List, Optional, Sequence, Tuple
+from datetime import date, datetime
+from sqlalchemy import func, text
 from . import salary_rules
 
-from .database import engine, get_db, Base
-from . import crud, schemas, models
+from .database import SessionLocal, engine, get_db, get_read_db
+from .migrations import SCHEMA_VERSION, current_schema_version
+from . import crud, schemas, models, payroll, reports, exports
+from .payroll import month_range
+from .cache import cached, report_cache
+from .events import broker, format_sse
+from .shared_state import REFERENCE_KEY, RULES_KEY, get_settings
+
+logger = logging.getLogger("dexsystem")
+
+# 資料表建立/遷移改由 migrate_db.py 在啟動前執行；啟動時只比對一次 schema 版本
+_schema_state = {"version": None}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _schema_state["version"] = current_schema_version()
+    if _schema_state["version"] != SCHEMA_VERSION:
+        logger.warning(
+            "資料庫 schema 版本 %s 與程式 %s 不符，請先執行 python migrate_db.py",
+            _schema_state["version"], SCHEMA_VERSION
+        )
+    events_task = broker.start(_load_change_events, _latest_change_seq)
+    yield
+    events_task.cancel()
 
-# 建立資料表
-Base.metadata.create_all(bind=engine)
 
 # 建立 FastAPI 應用
 app = FastAPI(
     title="DEXsystem API",
     description="數位化管理系統 - 薪資計算與課程管理",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+# 回應超過門檻才壓縮 (小回應壓縮反而浪費 CPU)；xlsx 本身已是 zip，不再壓縮以保留 Content-Length
+GZIP_MINIMUM_SIZE = 1000
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=GZIP_MINIMUM_SIZE,
+    exclude_content_types=(*DEFAULT_EXCLUDED_CONTENT_TYPES, exports.XLSX_MEDIA_TYPE)
+)
+
+FIELDS_DESCRIPTION = "只回傳指定欄位 (逗號分隔)，例如 fields=date,amount"
+EXPAND_DESCRIPTION = "在同一個查詢中加入關聯名稱，例如 expand=teacher,course (加入 teacher_name / course_name)"
+SORT_DESCRIPTION = "排序欄位 (逗號分隔，- 表示遞減)，例如 sort=-date,teacher_name"
+FILTER_DESCRIPTION = "篩選條件 欄位:運算子:值 (可重複)，運算子 eq/ne/lt/lte/gt/gte/contains/in，例如 filter=date:gte:2025-01-01"
+MAX_PAGE_SIZE = 1000
+
+
+def _resolve_fields(model, schema, fields: Optional[str]) -> list:
+    """
+    解析 fields 參數為欄位清單 (未知欄位回傳 400)
+    未指定時回傳 schema 的全部欄位 (順序與 schema 相同，輸出格式不變)
+    """
+    if not fields:
+        return [getattr(model, name) for name in schema.model_fields]
+    try:
+        return crud.resolve_fields(model, fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _resolve_expand(model, expand: Optional[str]) -> Optional[list]:
+    """解析 expand 參數為 join 清單 (未知關聯回傳 400)"""
+    if not expand:
+        return None
+    try:
+        return crud.resolve_expand(model, expand)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _resolve_listing(model, sort: Optional[str], filters: Optional[List[str]], joins: Optional[list]):
+    """解析列表的 sort / filter 參數 (錯誤回傳 400)"""
+    try:
+        order_by = crud.resolve_sort(model, sort or "", joins)
+        criteria = tuple(crud.resolve_filters(model, filters or [], joins))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return criteria, order_by
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _rows_content(rows) -> str:
+    """
+    大量讀取的輕量序列化：Core 查詢回傳的 tuple 直接轉 JSON
+    (略過 ORM 物件與 Pydantic from_attributes 驗證，輸出格式與 response_model 相同)
+    """
+    keys = rows[0]._fields if rows else ()
+    return json.dumps(
+        [dict(zip(keys, row)) for row in rows],
+        default=_json_default, ensure_ascii=False, separators=(",", ":")
+    )
+
+
+def _rows_response(rows) -> Response:
+    return Response(content=_rows_content(rows), media_type="application/json")
+
+
+def _json_response(content: str) -> Response:
+    return Response(content=content, media_type="application/json")
+
+
+@app.exception_handler(crud.MonthClosedError)
+def month_closed_handler(request: Request, exc: crud.MonthClosedError):
+    """已關帳月份的新增/刪除一律回傳 409"""
+    return JSONResponse(status_code=409, content={"detail": str(exc)})
+
+
+@app.exception_handler(salary_rules.SaleItemsLimitError)
+def sale_items_limit_handler(request: Request, exc: salary_rules.SaleItemsLimitError):
+    """金額超出自動推算明細的範圍回傳 422 (請求需附上 items)"""
+    return JSONResponse(status_code=422, content={"detail": str(exc)})
+
 
 # ========== Teacher API ==========
 @app.post("/teachers/", response_model=schemas.Teacher, tags=["Teachers"])
@@ -29,7 +144,7 @@ def create_teacher(teacher: schemas.TeacherCreate, db: Session = Depends(get_db)
 
 
 @app.get("/teachers/", response_model=List[schemas.Teacher], tags=["Teachers"])
-def read_teachers(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_teachers(skip: int = 0, limit: int = 100, db: Session = Depends(get_read_db)):
     """取得教練列表"""
     return crud.get_teachers(db, skip=skip, limit=limit)
 
@@ -43,6 +158,34 @@ def read_teacher(teacher_id: int, db: Session = Depends(get_db)):
     return db_teacher
 
 
+MAX_EARNINGS_RANGE_DAYS = 366  # 教練收入明細單次查詢的期間上限
+
+
+@app.get("/teachers/{teacher_id}/earnings", response_model=schemas.TeacherEarnings, tags=["Teachers"])
+def read_teacher_earnings(
+    teacher_id: int,
+    from_date: Optional[date] = Query(None, alias="from", description="起始日期 (預設本月 1 日)"),
+    to_date: Optional[date] = Query(None, alias="to", description="結束日期 (預設本月底)"),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_read_db)
+):
+    """教練個人收入明細：依日期排列的上課/賣課明細，附當月累計上課薪資、提成與總額"""
+    db_teacher = crud.get_teacher(db, teacher_id=teacher_id)
+    if db_teacher is None:
+        raise HTTPException(status_code=404, detail="教練不存在")
+    today = date.today()
+    month_start, month_end = month_range(today.year, today.month)
+    start_date = from_date or month_start
+    end_date = to_date or month_end
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="起始日期不可晚於結束日期")
+    if (end_date - start_date).days >= MAX_EARNINGS_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"期間最多 {MAX_EARNINGS_RANGE_DAYS} 天")
+    earnings = crud.get_teacher_earnings(db, teacher_id, start_date, end_date, skip=skip, limit=limit)
+    return {"teacher_id": teacher_id, "teacher_name": db_teacher.name, "start_date": start_date, "end_date": end_date, **earnings}
+
+
 @app.put("/teachers/{teacher_id}", response_model=schemas.Teacher, tags=["Teachers"])
 def update_teacher(teacher_id: int, teacher: schemas.TeacherCreate, db: Session = Depends(get_db)):
     """更新教練資料"""
@@ -69,7 +212,7 @@ def create_course(course: schemas.CourseCreate, db: Session = Depends(get_db)):
 
 
 @app.get("/courses/", response_model=List[schemas.Course], tags=["Courses"])
-def read_courses(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_courses(skip: int = 0, limit: int = 100, db: Session = Depends(get_read_db)):
     """取得課程列表"""
     return crud.get_courses(db, skip=skip, limit=limit)
 
@@ -108,10 +251,24 @@ def create_attendance(attendance: schemas.AttendanceCreate, db: Session = Depend
     return crud.create_attendance(db=db, attendance=attendance)
 
 
-@app.get("/attendances/", response_model=List[schemas.Attendance], tags=["Attendances"])
-def read_attendances(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    """取得上課紀錄列表"""
-    return crud.get_attendances(db, skip=skip, limit=limit)
+@app.get("/attendances/", response_model=List[schemas.AttendanceExpanded], tags=["Attendances"])
+def read_attendances(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    expand: Optional[str] = Query(None, description=EXPAND_DESCRIPTION),
+    sort: Optional[str] = Query(None, description=SORT_DESCRIPTION),
+    filter: Optional[List[str]] = Query(None, description=FILTER_DESCRIPTION),
+    db: Session = Depends(get_read_db)
+):
+    """取得上課紀錄列表 (分頁/排序/篩選在資料庫執行，總筆數放在 X-Total-Count)"""
+    columns = _resolve_fields(models.Attendance, schemas.Attendance, fields)
+    joins = _resolve_expand(models.Attendance, expand)
+    criteria, order_by = _resolve_listing(models.Attendance, sort, filter, joins)
+    rows = crud.get_attendances(db, skip=skip, limit=limit, columns=columns, joins=joins, criteria=criteria, order_by=order_by)
+    response = _rows_response(rows)
+    response.headers["X-Total-Count"] = str(crud.count_rows(db, models.Attendance, *criteria, joins=joins))
+    return response
 
 
 @app.get("/attendances/{attendance_id}", response_model=schemas.Attendance, tags=["Attendances"])
@@ -123,20 +280,37 @@ def read_attendance(attendance_id: int, db: Session = Depends(get_db)):
     return db_attendance
 
 
-@app.get("/attendances/teacher/{teacher_id}", response_model=List[schemas.Attendance], tags=["Attendances"])
-def read_attendances_by_teacher(teacher_id: int, db: Session = Depends(get_db)):
+@app.get("/attendances/teacher/{teacher_id}", response_model=List[schemas.AttendanceExpanded], tags=["Attendances"])
+def read_attendances_by_teacher(
+    teacher_id: int,
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    expand: Optional[str] = Query(None, description=EXPAND_DESCRIPTION),
+    db: Session = Depends(get_read_db)
+):
     """取得特定教練的所有上課紀錄"""
-    return crud.get_attendances_by_teacher(db, teacher_id=teacher_id)
+    columns = _resolve_fields(models.Attendance, schemas.Attendance, fields)
+    joins = _resolve_expand(models.Attendance, expand)
+    return _rows_response(crud.get_attendances_by_teacher(db, teacher_id=teacher_id, columns=columns, joins=joins))
 
 
-@app.get("/attendances/date-range/", response_model=List[schemas.Attendance], tags=["Attendances"])
+@app.get("/attendances/date-range/", response_model=List[schemas.AttendanceExpanded], tags=["Attendances"])
 def read_attendances_by_date_range(
     start_date: date = Query(..., description="起始日期"),
     end_date: date = Query(..., description="結束日期"),
-    db: Session = Depends(get_db)
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    expand: Optional[str] = Query(None, description=EXPAND_DESCRIPTION),
+    db: Session = Depends(get_read_db)
 ):
-    """取得特定日期範圍的上課紀錄"""
-    return crud.get_attendances_by_date_range(db, start_date=start_date, end_date=end_date)
+    """取得特定日期範圍的上課紀錄 (結果依該期間的資料版本快取)"""
+    columns = _resolve_fields(models.Attendance, schemas.Attendance, fields)
+    joins = _resolve_expand(models.Attendance, expand)
+    content = cached(
+        db, "attendances/date-range", (start_date, end_date, fields, expand),
+        payroll.months_between(start_date, end_date),
+        lambda: _rows_content(crud.get_attendances_by_date_range(db, start_date=start_date, end_date=end_date, columns=columns, joins=joins)),
+        extra_keys=(REFERENCE_KEY,) if joins else ()
+    )
+    return _json_response(content)
 
 
 @app.delete("/attendances/{attendance_id}", tags=["Attendances"])
@@ -149,19 +323,33 @@ def delete_attendance(attendance_id: int, db: Session = Depends(get_db)):
 
 
 # ========== Sales API ==========
-@app.post("/sales/", response_model=schemas.Sales, tags=["Sales"])
+@app.post("/sales/", response_model=schemas.SalesDetail, tags=["Sales"])
 def create_sales(sales: schemas.SalesCreate, db: Session = Depends(get_db)):
     """建立賣課紀錄（自動計算提成）"""
     return crud.create_sales(db=db, sales=sales)
 
 
-@app.get("/sales/", response_model=List[schemas.Sales], tags=["Sales"])
-def read_all_sales(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    """取得賣課紀錄列表"""
-    return crud.get_all_sales(db, skip=skip, limit=limit)
+@app.get("/sales/", response_model=List[schemas.SalesExpanded], tags=["Sales"])
+def read_all_sales(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    expand: Optional[str] = Query(None, description=EXPAND_DESCRIPTION),
+    sort: Optional[str] = Query(None, description=SORT_DESCRIPTION),
+    filter: Optional[List[str]] = Query(None, description=FILTER_DESCRIPTION),
+    db: Session = Depends(get_read_db)
+):
+    """取得賣課紀錄列表 (分頁/排序/篩選在資料庫執行，總筆數放在 X-Total-Count)"""
+    columns = _resolve_fields(models.Sales, schemas.Sales, fields)
+    joins = _resolve_expand(models.Sales, expand)
+    criteria, order_by = _resolve_listing(models.Sales, sort, filter, joins)
+    rows = crud.get_all_sales(db, skip=skip, limit=limit, columns=columns, joins=joins, criteria=criteria, order_by=order_by)
+    response = _rows_response(rows)
+    response.headers["X-Total-Count"] = str(crud.count_rows(db, models.Sales, *criteria, joins=joins))
+    return response
 
 
-@app.get("/sales/{sales_id}", response_model=schemas.Sales, tags=["Sales"])
+@app.get("/sales/{sales_id}", response_model=schemas.SalesDetail, tags=["Sales"])
 def read_sales(sales_id: int, db: Session = Depends(get_db)):
     """取得單一賣課紀錄"""
     db_sales = crud.get_sales(db, sales_id=sales_id)
@@ -170,20 +358,37 @@ def read_sales(sales_id: int, db: Session = Depends(get_db)):
     return db_sales
 
 
-@app.get("/sales/teacher/{teacher_id}", response_model=List[schemas.Sales], tags=["Sales"])
-def read_sales_by_teacher(teacher_id: int, db: Session = Depends(get_db)):
+@app.get("/sales/teacher/{teacher_id}", response_model=List[schemas.SalesExpanded], tags=["Sales"])
+def read_sales_by_teacher(
+    teacher_id: int,
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    expand: Optional[str] = Query(None, description=EXPAND_DESCRIPTION),
+    db: Session = Depends(get_read_db)
+):
     """取得特定教練的所有賣課紀錄"""
-    return crud.get_sales_by_teacher(db, teacher_id=teacher_id)
+    columns = _resolve_fields(models.Sales, schemas.Sales, fields)
+    joins = _resolve_expand(models.Sales, expand)
+    return _rows_response(crud.get_sales_by_teacher(db, teacher_id=teacher_id, columns=columns, joins=joins))
 
 
-@app.get("/sales/date-range/", response_model=List[schemas.Sales], tags=["Sales"])
+@app.get("/sales/date-range/", response_model=List[schemas.SalesExpanded], tags=["Sales"])
 def read_sales_by_date_range(
     start_date: date = Query(..., description="起始日期"),
     end_date: date = Query(..., description="結束日期"),
-    db: Session = Depends(get_db)
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    expand: Optional[str] = Query(None, description=EXPAND_DESCRIPTION),
+    db: Session = Depends(get_read_db)
 ):
-    """取得特定日期範圍的賣課紀錄"""
-    return crud.get_sales_by_date_range(db, start_date=start_date, end_date=end_date)
+    """取得特定日期範圍的賣課紀錄 (結果依該期間的資料版本快取)"""
+    columns = _resolve_fields(models.Sales, schemas.Sales, fields)
+    joins = _resolve_expand(models.Sales, expand)
+    content = cached(
+        db, "sales/date-range", (start_date, end_date, fields, expand),
+        payroll.months_between(start_date, end_date),
+        lambda: _rows_content(crud.get_sales_by_date_range(db, start_date=start_date, end_date=end_date, columns=columns, joins=joins)),
+        extra_keys=(REFERENCE_KEY,) if joins else ()
+    )
+    return _json_response(content)
 
 
 @app.delete("/sales/{sales_id}", tags=["Sales"])
@@ -195,7 +400,115 @@ def delete_sales(sales_id: int, db: Session = Depends(get_db)):
     return {"message": "刪除成功"}
 
 
+# ========== Submission API ==========
+@app.post("/submissions/batch", response_model=List[schemas.SubmissionResult], tags=["Submissions"])
+def submit_batch(batch: schemas.SubmissionBatch, db: Session = Depends(get_db)):
+    """
+    前端送出佇列的批次上傳：逐筆建立上課/賣課紀錄，每筆回傳 created / duplicate / rejected
+    以冪等鍵判斷是否已建立，整批重送不會重複新增
+    """
+    return [crud.apply_submission(db, item) for item in batch.items]
+
 
+# ========== Sync API ==========
+def _with_id(model, columns: list) -> list:
+    """增量同步以 id 合併，欄位一定包含 id"""
+    return columns if any(column.key == "id" for column in columns) else [model.id] + columns
+
+
+def _rows_as_dicts(rows) -> list:
+    return [dict(row._mapping) for row in rows]
+
+
+@app.get("/sync/month", response_model=schemas.MonthSync, tags=["Sync"])
+def sync_month(
+    year: int = Query(..., description="年份"),
+    month: int = Query(..., ge=1, le=12, description="月份"),
+    since: int = Query(0, ge=0, description="上次同步的異動序號 (0 表示取完整快照)"),
+    attendance_fields: Optional[str] = Query(None, description="上課紀錄欄位 (逗號分隔)"),
+    sales_fields: Optional[str] = Query(None, description="賣課紀錄欄位 (逗號分隔)"),
+    db: Session = Depends(get_read_db)
+):
+    """
+    依月份增量同步上課/賣課紀錄：
+    since=0 或期間內有整月重算 (reset) 時回傳完整快照，否則只回傳 since 之後新增的紀錄與被刪除的 id
+    回傳的 seq 停在尚未提交的較小序號之前 (見 crud.get_sync_change_seq)，晚提交的異動會在之後的同步送出
+    """
+    attendance_columns = _with_id(models.Attendance, _resolve_fields(models.Attendance, schemas.Attendance, attendance_fields))
+    sales_columns = _with_id(models.Sales, _resolve_fields(models.Sales, schemas.Sales, sales_fields))
+    start_date, end_date = month_range(year, month)
+    # 先讀序號再讀資料：之後發生的異動會在下一次同步重送 (依 id 合併，重複套用無影響)
+    seq = crud.get_sync_change_seq(db, since)
+    
+    changes = crud.get_month_changes(db, start_date, end_date, since, seq) if since else []
+    if not since or any(change.op == "reset" for change in changes):
+        return {
+            "seq": seq,
+            "full": True,
+            "attendances": _rows_as_dicts(crud.get_attendances_by_date_range(db, start_date, end_date, columns=attendance_columns)),
+            "sales": _rows_as_dicts(crud.get_sales_by_date_range(db, start_date, end_date, columns=sales_columns)),
+        }
+    
+    created = {"attendance": [], "sales": []}
+    deleted = {"attendance": [], "sales": []}
+    for change in changes:
+        (created if change.op == "create" else deleted)[change.kind].append(change.record_id)
+    return {
+        "seq": seq,
+        "full": False,
+        "attendances": _rows_as_dicts(crud.get_rows_by_ids(db, models.Attendance, attendance_columns, created["attendance"])),
+        "sales": _rows_as_dicts(crud.get_rows_by_ids(db, models.Sales, sales_columns, created["sales"])),
+        "deleted_attendances": deleted["attendance"],
+        "deleted_sales": deleted["sales"],
+    }
+
+
+# ========== Reports API ==========
+@app.get("/reports/sales-by-plan", response_model=List[schemas.PlanSalesReport], tags=["Reports"])
+def read_plan_sales_report(
+    start_date: date = Query(..., description="起始日期"),
+    end_date: date = Query(..., description="結束日期"),
+    db: Session = Depends(get_read_db)
+):
+    """依方案彙總售出數量、營收與提成 (來自賣課明細)"""
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="起始日期不可晚於結束日期")
+    content = cached(
+        db, "reports/sales-by-plan", (start_date, end_date),
+        payroll.months_between(start_date, end_date),
+        lambda: _rows_content(crud.get_plan_sales_report(db, start_date=start_date, end_date=end_date))
+    )
+    return _json_response(content)
+
+
+@app.get("/reports/aggregate", tags=["Reports"])
+def read_aggregate_report(
+    metrics: str = Query(..., description=f"指標 (逗號分隔)：{', '.join(reports.METRICS)}"),
+    group_by: Optional[str] = Query(None, description=f"分組維度 (逗號分隔)：{', '.join(reports.DIMENSIONS)}"),
+    start_date: Optional[date] = Query(None, description="起始日期"),
+    end_date: Optional[date] = Query(None, description="結束日期"),
+    teacher_id: Optional[int] = Query(None, description="只統計特定教練"),
+    db: Session = Depends(get_read_db)
+):
+    """
+    彙總報表：例如 metrics=amount&group_by=month、metrics=avg_students&group_by=course、
+    metrics=classes&group_by=teacher,week (每個請求編譯為單一 GROUP BY，結果依資料版本快取)
+    """
+    if start_date and end_date and start_date > end_date:
+        raise HTTPException(status_code=400, detail="起始日期不可晚於結束日期")
+    try:
+        stmt = reports.build_aggregate_query(metrics, group_by, start_date, end_date, teacher_id, db.get_bind().dialect.name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # 不限期間時以所有月份的版本判斷是否過期
+    months = payroll.months_between(start_date, end_date) if start_date and end_date else None
+    content = cached(
+        db, "reports/aggregate", (metrics, group_by, start_date, end_date, teacher_id),
+        months,
+        lambda: json.dumps(reports.run_aggregate(db, stmt), default=_json_default, ensure_ascii=False, separators=(",", ":")),
+        extra_keys=(REFERENCE_KEY,)
+    )
+    return _json_response(content)
 
 
 # ========== Admin API ==========
@@ -219,14 +532,9 @@ def get_historical_rules(
     db: Session = Depends(get_db)
 ):
     """取得特定月份的薪資規則 (若該月無紀錄，則回傳目前規則)"""
-    db_rule = crud.get_monthly_salary_rule(db, year, month)
-    if db_rule:
-        import json
-        return json.loads(db_rule.rules_json)
-    
     # Fallback: 若無歷史紀錄，回傳目前規則 (或你要回傳空列表/錯誤)
     # 這裡依照需求：若調用前月資料時，用儲存的那份 rule... 若沒存到，這也是個 fallback
-    return salary_rules.load_rules()
+    return crud.get_rules_for_month(db, year, month)
 
 
 @app.post("/admin/rules", tags=["Admin"])
@@ -234,45 +542,314 @@ def update_salary_rules(rules: schemas.SalaryRulesUpdate, db: Session = Depends(
     """更新薪資門檻規則 (同步更新當月快照)"""
     # 轉換為 dict list 儲存
     tiers_data = [tier.dict() for tier in rules.tiers]
-    salary_rules.save_rules(tiers_data)
+    salary_rules.save_rules(tiers_data, db)
     
     # Side Effect: 更新當月規則快照
     today = date.today()
     crud.upsert_monthly_salary_rule(db, today.year, today.month, tiers_data)
     
-    return {"message": "規則更新成功"}
+    # Side Effect: 重算當月已存的 calculated_salary (已關帳月份維持凍結)
+    updated = 0
+    if not crud.get_payroll_close(db, today.year, today.month):
+        updated = _recalculate_month(db, today.year, today.month, tiers_data)
+    
+    return {"message": "規則更新成功", "recalculated": updated}
+
+
+def _recalculate_month(db: Session, year: int, month: int, tiers: List[dict]) -> int:
+    """以 tiers 分批重算某月份的上課薪資並記錄進度"""
+    start_date, end_date = month_range(year, month)
+    
+    def log_progress(done: int, total: int):
+        logger.info("重算 %d/%02d calculated_salary: %d/%d", year, month, done, total)
+    
+    return crud.recalculate_attendance_salaries(db, start_date, end_date, tiers, progress=log_progress)
+
+
+@app.post("/admin/rules/recalculate", tags=["Admin"])
+def recalculate_salaries(
+    year: int = Query(..., description="年份"),
+    month: int = Query(..., ge=1, le=12, description="月份"),
+    db: Session = Depends(get_db)
+):
+    """依該月規則快照重算已存的上課薪資 (已關帳月份回傳 409)"""
+    crud.ensure_month_open(db, date(year, month, 1))
+    tiers = crud.get_rules_for_month(db, year, month)
+    updated = _recalculate_month(db, year, month, tiers)
+    return {"message": "重算完成", "recalculated": updated}
+
+
+@app.post("/admin/rules/simulate", response_model=schemas.RuleSimulationResult, tags=["Admin"])
+def simulate_salary_rules(request: schemas.RuleSimulationRequest, db: Session = Depends(get_read_db)):
+    """規則變更試算：比較一或多組候選級距與現行規則在期間內的上課薪資差異 (不寫入資料)"""
+    if request.start_date > request.end_date:
+        raise HTTPException(status_code=400, detail="起始日期不可晚於結束日期")
+    rules_by_month = {
+        (year, month): crud.get_rules_in_force(db, year, month)
+        for year, month in payroll.months_between(request.start_date, request.end_date)
+    }
+    candidates = [[tier.model_dump() for tier in tiers] for tiers in request.candidates]
+    return payroll.simulate_rule_changes(db, request.start_date, request.end_date, candidates, rules_by_month)
 
 
 @app.get("/admin/stats", response_model=schemas.MonthlyStats, tags=["Admin"])
 def get_monthly_stats(
     year: int = date.today().year, 
     month: int = date.today().month, 
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
-    """取得月度統計（總收入 vs 總支出）"""
-    # 計算總收入 (Sales.amount)
-    total_revenue = db.query(func.sum(models.Sales.amount)).filter(
-        extract('year', models.Sales.date) == year,
-        extract('month', models.Sales.date) == month
-    ).scalar() or 0.0
+    """取得月度統計（總收入 vs 總支出，結果依該月資料版本快取）"""
+    start_date, end_date = month_range(year, month)
     
-    # 計算總支出 (Attendance.calculated_salary + Sales.commission)
-    salary_expense = db.query(func.sum(models.Attendance.calculated_salary)).filter(
-        extract('year', models.Attendance.date) == year,
-        extract('month', models.Attendance.date) == month
-    ).scalar() or 0.0
+    def compute() -> dict:
+        # 計算總收入 (Sales.amount)
+        total_revenue = db.query(func.sum(models.Sales.amount)).filter(
+            models.Sales.date >= start_date,
+            models.Sales.date <= end_date
+        ).scalar() or 0.0
+        
+        # 計算總支出 (Attendance.calculated_salary + Sales.commission)
+        salary_expense = db.query(func.sum(models.Attendance.calculated_salary)).filter(
+            models.Attendance.date >= start_date,
+            models.Attendance.date <= end_date
+        ).scalar() or 0.0
+        
+        commission_expense = db.query(func.sum(models.Sales.commission)).filter(
+            models.Sales.date >= start_date,
+            models.Sales.date <= end_date
+        ).scalar() or 0.0
+        
+        total_expenses = salary_expense + commission_expense
+        
+        return {
+            "year": year,
+            "month": month,
+            "total_revenue": total_revenue,
+            "total_expenses": total_expenses,
+            "net_income": total_revenue - total_expenses
+        }
     
-    commission_expense = db.query(func.sum(models.Sales.commission)).filter(
-        extract('year', models.Sales.date) == year,
-        extract('month', models.Sales.date) == month
-    ).scalar() or 0.0
+    return cached(db, "admin/stats", (year, month), [(year, month)], compute)
+
+
+@app.get("/admin/cache/stats", tags=["Admin"])
+def get_cache_stats():
+    """報表快取統計 (本 worker)：命中/未命中/淘汰次數與目前筆數"""
+    return report_cache.stats()
+
+
+
+# ========== Payroll Close API ==========
+def _closed_payroll_response(db: Session, db_close: models.MonthlyPayrollClose) -> dict:
+    """組合關帳結果 (直接讀取凍結列，不重算)"""
+    return {
+        "year": db_close.year,
+        "month": db_close.month,
+        "content_hash": db_close.content_hash,
+        "closed_at": db_close.closed_at,
+        "tiers": json.loads(db_close.rules_json),
+        "rows": crud.get_closed_payroll(db, db_close.year, db_close.month)
+    }
+
+
+@app.get("/admin/payroll/closed", response_model=schemas.ClosedPayroll, tags=["Payroll"])
+def read_closed_payroll(
+    year: int = Query(..., description="年份"),
+    month: int = Query(..., description="月份"),
+    db: Session = Depends(get_read_db)
+):
+    """取得已關帳月份的凍結薪資 (未關帳回傳 404)"""
+    db_close = crud.get_payroll_close(db, year, month)
+    if db_close is None:
+        raise HTTPException(status_code=404, detail="該月份尚未關帳")
+    return _closed_payroll_response(db, db_close)
+
+
+MAX_PAYROLL_RANGE_MONTHS = 36
+MONTH_PATTERN = r"^\d{4}-(0[1-9]|1[0-2])$"
+
+
+def _payroll_range(db: Session, start: str, end: str) -> Tuple[List[Tuple[int, int]], dict]:
+    """驗證期間並取得多月份薪資矩陣 (經報表快取)；回傳 (月份清單, 結果)"""
+    start_date = date(int(start[:4]), int(start[5:]), 1)
+    end_date = date(int(end[:4]), int(end[5:]), 1)
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="起始月份不可晚於結束月份")
+    months = payroll.months_between(start_date, end_date)
+    if len(months) > MAX_PAYROLL_RANGE_MONTHS:
+        raise HTTPException(status_code=400, detail=f"期間最多 {MAX_PAYROLL_RANGE_MONTHS} 個月")
+
+    def compute():
+        frozen = crud.get_closed_payrolls(db, months)
+        rules_by_month = {key: crud.get_rules_in_force(db, *key) for key in months if key not in frozen}
+        return {"start": start, "end": end, **payroll.compute_range_payroll(db, months, rules_by_month, frozen)}
+
+    return months, cached(db, "admin/payroll/range", (start, end), months, compute, extra_keys=(RULES_KEY, REFERENCE_KEY))
+
+
+@app.get("/admin/payroll/range", response_model=schemas.PayrollRange, tags=["Payroll"])
+def read_payroll_range(
+    start: str = Query(..., pattern=MONTH_PATTERN, description="起始月份 YYYY-MM"),
+    end: str = Query(..., pattern=MONTH_PATTERN, description="結束月份 YYYY-MM (含)"),
+    db: Session = Depends(get_read_db)
+):
+    """
+    多月份薪資矩陣 (教練 × 月份)，用於季報、年初至今與自訂期間
+    未關帳月份依各月規則一次計算，已關帳月份直接使用凍結結果
+    """
+    return _payroll_range(db, start, end)[1]
+
+
+@app.get("/exports/payroll.xlsx", tags=["Exports"])
+def export_payroll_xlsx(
+    start: str = Query(..., pattern=MONTH_PATTERN, description="起始月份 YYYY-MM"),
+    end: str = Query(..., pattern=MONTH_PATTERN, description="結束月份 YYYY-MM (含)"),
+    db: Session = Depends(get_read_db)
+):
+    """
+    期間薪資 Excel 活頁簿：薪資總表、上課明細、賣課明細
+    以 constant_memory 模式寫入暫存檔後分段串流，回應結束 (含連線中斷) 後由背景工作刪除
+    """
+    months, payroll_range = _payroll_range(db, start, end)
+    path = exports.export_payroll_workbook(db, payroll_range, month_range(*months[0])[0], month_range(*months[-1])[1])
+    return FileResponse(
+        path,
+        media_type=exports.XLSX_MEDIA_TYPE,
+        filename=f"payroll_{start}_{end}.xlsx",
+        background=BackgroundTask(exports.remove_file, path)
+    )
+
+
+@app.post("/admin/payroll/close", response_model=schemas.ClosedPayroll, tags=["Payroll"])
+def close_payroll_month(
+    year: int = Query(..., description="年份"),
+    month: int = Query(..., ge=1, le=12, description="月份"),
+    db: Session = Depends(get_db)
+):
+    """月結關帳：以該月規則計算並凍結薪資 (已關帳則重新關帳)"""
+    db_close = crud.close_month(db, year, month)
+    return _closed_payroll_response(db, db_close)
+
+
+@app.delete("/admin/payroll/close", tags=["Payroll"])
+def reopen_payroll_month(
+    year: int = Query(..., description="年份"),
+    month: int = Query(..., description="月份"),
+    db: Session = Depends(get_db)
+):
+    """重新開帳：解除凍結，允許補登/刪除該月紀錄"""
+    success = crud.reopen_month(db, year, month)
+    if not success:
+        raise HTTPException(status_code=404, detail="該月份尚未關帳")
+    return {"message": "已重新開帳"}
+
+
+
+# ========== Events API ==========
+SSE_KEEPALIVE_SECONDS = 15
+
+
+def _load_change_events(since: int, limit: int, include_ids: Sequence[int] = ()) -> List[dict]:
+    """事件廣播的資料來源：讀主庫的異動日誌 (副本可能落後)"""
+    with SessionLocal() as db:
+        return crud.get_change_events(db, since, limit, include_ids)
+
+
+def _latest_change_seq() -> int:
+    with SessionLocal() as db:
+        return crud.get_latest_change_seq(db)
+
+
+@app.get("/events/stream", tags=["Events"])
+async def stream_events(request: Request, last_event_id: Optional[int] = Header(None)):
+    """
+    Server-Sent Events：上課/賣課紀錄新增或刪除時推送精簡事件 (id 為異動序號)
+    斷線重連時瀏覽器會帶 Last-Event-ID，伺服器從異動日誌補送之後的事件 (連到任一 worker 皆可)
+    晚提交的事件 id 可能小於已送出的 id；收到 kind=all、op=reset 時客戶端應整批重新載入
+    """
+    sub = await broker.subscribe(last_event_id)
+
+    async def event_generator():
+        try:
+            yield "retry: 3000\n\n"
+            # 先告知訂閱起點：客戶端可確認與上次收到的序號是否銜接
+            yield format_sse({"id": sub.start_id, "kind": "ready"})
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event)
+        finally:
+            broker.unsubscribe(sub)
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+
+# ========== Bootstrap API ==========
+# 方案目錄寫在程式碼中，部署更新時以內容雜湊區分版本
+_PLAN_CATALOG_TAG = hashlib.sha1(
+    json.dumps(salary_rules.PLAN_CATALOG, ensure_ascii=False, sort_keys=True).encode("utf-8")
+).hexdigest()[:8]
+
+
+@app.get("/bootstrap", response_model=schemas.Bootstrap, tags=["Bootstrap"])
+def read_bootstrap(
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    """
+    表單所需資料一次取得：教練、課程、方案目錄 (售價/提成)、目前薪資級距
+    回傳 ETag；帶 If-None-Match 且版本未變時回傳 304 (只查版本，不讀資料)
+    """
+    salary_rules.load_rules()  # 確保規則已初始化
+    settings = get_settings(db, [REFERENCE_KEY, RULES_KEY])
+    reference_version = settings[REFERENCE_KEY].version if REFERENCE_KEY in settings else 0
+    rules_setting = settings[RULES_KEY]
+    version = f"{reference_version}.{rules_setting.version}.{_PLAN_CATALOG_TAG}"
+    etag = f'"{version}"'
     
-    total_expenses = salary_expense + commission_expense
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
     
+    response.headers["ETag"] = etag
     return {
-        "year": year,
-        "month": month,
-        "total_revenue": total_revenue,
-        "total_expenses": total_expenses,
-        "net_income": total_revenue - total_expenses
+        "version": version,
+        "teachers": db.query(models.Teacher).order_by(models.Teacher.id).all(),
+        "courses": db.query(models.Course).order_by(models.Course.id).all(),
+        "plans": salary_rules.PLAN_CATALOG,
+        "tiers": json.loads(rules_setting.value)
+    }
+
+
+
+# ========== Health API ==========
+@app.get("/healthz", tags=["Health"])
+def healthz():
+    """就緒檢查：資料庫可連線且 schema 版本正確時回傳 200，否則 503"""
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        database_ok = True
+    except Exception:
+        database_ok = False
+    
+    # 啟動時版本不符 (例如遷移在啟動後才完成) 時重新讀取一次
+    if database_ok and _schema_state["version"] != SCHEMA_VERSION:
+        _schema_state["version"] = current_schema_version()
+    schema_ok = _schema_state["version"] == SCHEMA_VERSION
+    
+    body = {
+        "status": "ok" if database_ok and schema_ok else "unavailable",
+        "database": "ok" if database_ok else "unreachable",
+        "schema_version": _schema_state["version"],
+        "expected_schema_version": SCHEMA_VERSION
     }
+    return JSONResponse(status_code=200 if database_ok and schema_ok else 503, content=body)
@@ -0,0 +1,130 @@
+"""
+資料庫結構遷移模組
+========================
+建立資料表與補齊欄位統一在部署/啟動前的明確步驟執行 (python migrate_db.py)，
+API 程序啟動時只讀取一次 schema_version 做比對，不再每次 import 檢查所有資料表。
+"""
+import json
+from typing import List, Optional
+
+from sqlalchemy import insert, inspect, select, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import models  # noqa: F401  (註冊所有資料表到 Base.metadata)
+from .database import Base, SessionLocal, engine
+from .salary_rules import infer_sale_items
+from .shared_state import data_key, get_month_states, get_setting, set_setting
+
+# 資料庫結構版本：新增資料表/欄位/索引時遞增
+SCHEMA_VERSION = 5  # 2: sale_items 賣課明細；3: (teacher_id, date) 索引；4: record_changes 異動日誌；5: idempotency_key
+SCHEMA_VERSION_KEY = "schema_version"
+
+
+def _sql_literal(value) -> str:
+    """欄位預設值轉為 SQL 字面值"""
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def _add_missing_columns() -> List[str]:
+    """補齊既有資料表缺少的欄位 (取代原本 migrate_db.py 的手寫 ALTER TABLE)"""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    added = []
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                default = column.default.arg if column.default is not None and column.default.is_scalar else None
+                if default is not None:
+                    ddl += f" DEFAULT {_sql_literal(default)}"
+                conn.execute(text(ddl))
+                added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def _create_missing_indexes() -> List[str]:
+    """為既有資料表補建新增的索引 (create_all 只會為新建立的資料表建索引)"""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    created = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=engine, checkfirst=True)
+                created.append(index.name)
+    return created
+
+
+def _backfill_sale_items(batch_size: int = 1000) -> int:
+    """為沒有明細的歷史賣課紀錄推算 sale_items (可重複執行，只處理尚未回填的紀錄)"""
+    has_items = select(models.SaleItem.id).where(models.SaleItem.sales_id == models.Sales.id).exists()
+    stmt = select(
+        models.Sales.id,
+        models.Sales.plan_type,
+        models.Sales.amount,
+        models.Sales.custom_amount,
+        models.Sales.commission
+    ).where(~has_items).order_by(models.Sales.id)
+
+    backfilled = 0
+    with engine.begin() as conn:
+        rows = conn.execute(stmt).all()
+        for start in range(0, len(rows), batch_size):
+            values = [
+                {"sales_id": sales_id, **item}
+                for sales_id, plan_type, amount, custom_amount, commission in rows[start:start + batch_size]
+                for item in infer_sale_items(plan_type, amount, custom_amount, commission)
+            ]
+            if values:
+                conn.execute(insert(models.SaleItem), values)
+        backfilled = len(rows)
+    return backfilled
+
+
+def _sync_closed_month_flags() -> int:
+    """在每月資料版本上標記已關帳的月份 (報表快取依此固定保存結果)"""
+    with SessionLocal() as db:
+        months = [(close.year, close.month) for close in db.query(models.MonthlyPayrollClose).all()]
+        states = get_month_states(db, months)
+        missing = [month for month, (_, closed) in states.items() if not closed]
+        for year, month in missing:
+            set_setting(db, data_key(year, month), {"closed": True}, commit=False)
+        db.commit()
+    return len(missing)
+
+
+def migrate() -> List[str]:
+    """建立缺少的資料表/索引、補齊欄位、回填資料，並寫入 schema_version；回傳執行過的變更"""
+    changes = [f"Added column {column}" for column in _add_missing_columns()]
+    changes += [f"Created index {index}" for index in _create_missing_indexes()]
+    Base.metadata.create_all(bind=engine)
+    backfilled = _backfill_sale_items()
+    if backfilled:
+        changes.append(f"Backfilled sale_items for {backfilled} sales")
+    flagged = _sync_closed_month_flags()
+    if flagged:
+        changes.append(f"Marked {flagged} closed months in data versions")
+    with SessionLocal() as db:
+        set_setting(db, SCHEMA_VERSION_KEY, SCHEMA_VERSION)
+    return changes
+
+
+def current_schema_version() -> Optional[int]:
+    """讀取資料庫記錄的 schema_version (尚未遷移或無法連線回傳 None)"""
+    try:
+        with SessionLocal() as db:
+            db_setting = get_setting(db, SCHEMA_VERSION_KEY)
+            return json.loads(db_setting.value) if db_setting else None
+    except SQLAlchemyError:
+        return None
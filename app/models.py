@@ -1,4 +1,6 @@
-from sqlalchemy import Column, Integer, String, Float, Date, ForeignKey
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from .database import Base
 
@@ -37,10 +39,16 @@ class Attendance(Base):
     course_id = Column(Integer, ForeignKey("courses.id"), nullable=False)
     student_count = Column(Integer, nullable=False)  # 上課人數
     calculated_salary = Column(Float, nullable=False)  # 計算後的薪資
+    idempotency_key = Column(String, nullable=True)  # 前端送出佇列產生，重送時不重複建立
     
     # 關聯
     teacher = relationship("Teacher", back_populates="attendances")
     course = relationship("Course", back_populates="attendances")
+    
+    __table_args__ = (
+        Index("ix_attendances_teacher_date", "teacher_id", "date"),  # 教練個人期間查詢
+        Index("ix_attendances_idempotency_key", "idempotency_key", unique=True),
+    )
 
 
 class Sales(Base):
@@ -55,9 +63,53 @@ class Sales(Base):
     commission = Column(Float, nullable=False)  # 教練提成
     note = Column(String, nullable=True)  # 備註
     custom_amount = Column(Float, default=0)  # 自訂金額
+    idempotency_key = Column(String, nullable=True)  # 前端送出佇列產生，重送時不重複建立
     
     # 關聯
     teacher = relationship("Teacher", back_populates="sales")
+    items = relationship("SaleItem", back_populates="sales", cascade="all, delete-orphan")
+    
+    __table_args__ = (
+        Index("ix_sales_teacher_date", "teacher_id", "date"),  # 教練個人期間查詢
+        Index("ix_sales_idempotency_key", "idempotency_key", unique=True),
+    )
+
+
+class SaleItem(Base):
+    """賣課明細 (每個方案一列，保留當下的售價與提成)"""
+    __tablename__ = "sale_items"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    sales_id = Column(Integer, ForeignKey("sales.id", ondelete="CASCADE"), nullable=False, index=True)
+    plan = Column(String, nullable=False, index=True)  # 方案代碼，例如 "方案A"；特殊金額為 "特殊金額"
+    quantity = Column(Integer, nullable=False)  # 數量
+    unit_price = Column(Float, nullable=False)  # 單價
+    unit_commission = Column(Float, nullable=False)  # 單位提成
+    
+    # 關聯
+    sales = relationship("Sales", back_populates="items")
+
+
+class RecordChange(Base):
+    """上課/賣課紀錄的異動日誌 (seq 遞增)，供前端依月份做增量同步"""
+    __tablename__ = "record_changes"
+    
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String, nullable=False)  # "attendance" 或 "sales"
+    op = Column(String, nullable=False)  # "create" / "delete" / "reset" (整月需重新載入，例如重算薪資)
+    record_id = Column(Integer, nullable=False)  # reset 時為 0
+    record_date = Column(Date, nullable=False, index=True)  # 紀錄所屬日期 (reset 為該月 1 日)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+
+
+class SystemSetting(Base):
+    """共用設定 (薪資規則等)，以 version 讓多個 worker 偵測變更"""
+    __tablename__ = "system_settings"
+    
+    key = Column(String, primary_key=True)
+    value = Column(String, nullable=True)  # JSON string
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
 
 
 class MonthlySalaryRule(Base):
@@ -76,3 +128,29 @@ class MonthlySalaryRule(Base):
     __table_args__ = (
         # Index("ix_year_month", "year", "month", unique=True), # 需要 import Index
     )
+
+
+class MonthlyPayrollClose(Base):
+    """月結關帳紀錄 (關帳後該月薪資凍結，不再重算)"""
+    __tablename__ = "monthly_payroll_closes"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    year = Column(Integer, nullable=False, index=True)
+    month = Column(Integer, nullable=False, index=True)
+    rules_json = Column(String, nullable=False)  # 關帳時使用的級距規則
+    content_hash = Column(String, nullable=False)  # 原始紀錄 + 規則的 SHA-256
+    closed_at = Column(DateTime, nullable=False, default=datetime.now)
+
+
+class MonthlyPayroll(Base):
+    """月結薪資凍結結果 (每月每位教練一列)"""
+    __tablename__ = "monthly_payrolls"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    year = Column(Integer, nullable=False, index=True)
+    month = Column(Integer, nullable=False, index=True)
+    teacher_id = Column(Integer, ForeignKey("teachers.id"), nullable=False)
+    teacher_name = Column(String, nullable=False)  # 關帳當下的教練姓名
+    base_salary = Column(Float, nullable=False)  # 上課薪資
+    commission = Column(Float, nullable=False)  # 銷售提成
+    total = Column(Float, nullable=False)  # 總薪資
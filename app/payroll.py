@@ -0,0 +1,297 @@
+"""
+月結薪資計算模組
+========================
+依指定月份的級距規則，從原始上課/賣課紀錄計算每位教練的薪資，
+並產生內容雜湊 (content hash) 供關帳凍結與事後核對使用。
+另提供規則變更試算 (what-if)，以查表陣列一次評估多組候選規則，
+以及多月份 (季、年初至今、自訂期間) 的教練 × 月份薪資矩陣。
+"""
+import calendar
+import hashlib
+import json
+from collections import Counter
+from datetime import date
+from typing import List, Dict, Tuple
+
+import numpy as np
+from sqlalchemy import extract, func
+from sqlalchemy.orm import Session
+
+from . import models
+from .salary_rules import lookup_tier_amount
+
+
+def month_range(year: int, month: int) -> Tuple[date, date]:
+    """取得該月份的第一天與最後一天"""
+    last_day = calendar.monthrange(year, month)[1]
+    return date(year, month, 1), date(year, month, last_day)
+
+
+def compute_month_payroll(db: Session, year: int, month: int, tiers: List[Dict]) -> Tuple[List[Dict], str]:
+    """
+    計算某月份每位教練的薪資
+    回傳 (每位教練結果列表, 內容雜湊)
+    - 上課薪資：依傳入的 tiers 重新計算
+    - 銷售提成：沿用紀錄中的 commission
+    """
+    start_date, end_date = month_range(year, month)
+
+    attendances = db.query(
+        models.Attendance.id,
+        models.Attendance.teacher_id,
+        models.Attendance.student_count
+    ).filter(
+        models.Attendance.date >= start_date,
+        models.Attendance.date <= end_date
+    ).order_by(models.Attendance.id).all()
+
+    sales = db.query(
+        models.Sales.id,
+        models.Sales.teacher_id,
+        models.Sales.commission
+    ).filter(
+        models.Sales.date >= start_date,
+        models.Sales.date <= end_date
+    ).order_by(models.Sales.id).all()
+
+    teacher_map = {t.id: t.name for t in db.query(models.Teacher.id, models.Teacher.name).all()}
+
+    # 初始化
+    salary_data = {
+        tid: {"teacher_id": tid, "teacher_name": tname, "base_salary": 0.0, "commission": 0.0, "total": 0.0}
+        for tid, tname in teacher_map.items()
+    }
+
+    for _, tid, count in attendances:
+        if tid not in salary_data:
+            continue  # 略過未知教練
+        salary_data[tid]["base_salary"] += lookup_tier_amount(count, tiers)
+
+    for _, tid, commission in sales:
+        if tid not in salary_data:
+            continue
+        if commission:
+            salary_data[tid]["commission"] += float(commission)
+
+    results = []
+    for row in salary_data.values():
+        row["total"] = row["base_salary"] + row["commission"]
+        if row["total"] > 0:
+            results.append(row)
+    results.sort(key=lambda r: r["total"], reverse=True)
+
+    # 內容雜湊：原始紀錄 + 規則，任何一筆變動都會改變雜湊值
+    payload = {
+        "year": year,
+        "month": month,
+        "tiers": tiers,
+        "attendances": [list(r) for r in attendances],
+        "sales": [[r[0], r[1], float(r[2] or 0)] for r in sales],
+    }
+    content_hash = hashlib.sha256(
+        json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+    return results, content_hash
+
+
+def _tier_table(tiers: List[Dict], max_count: int) -> np.ndarray:
+    """
+    將級距規則展開成查表陣列：table[人數] = 薪資
+    與 lookup_tier_amount 相同：第一個符合的級距優先，都不符合時使用最後一個級距
+    """
+    fallback = float(tiers[-1]["amount"]) if tiers else 0.0
+    table = np.full(max_count + 1, fallback)
+    # 反向套用，讓排在前面的級距覆蓋後面的
+    for tier in reversed(tiers):
+        lo = max(int(tier["min"]), 0)
+        hi = min(int(tier["max"]), max_count)
+        if lo <= hi:
+            table[lo:hi + 1] = float(tier["amount"])
+    return table
+
+
+def _student_count_distribution(db: Session, start_date: date, end_date: date) -> List[Tuple]:
+    """
+    期間內上課堂數分布：(教練, 年, 月, 人數, 堂數)
+    資料庫端以 (教練, 日期, 人數) 分組 (不需逐列計算年月)，再於程式端併成月份
+    """
+    grouped = db.query(
+        models.Attendance.teacher_id,
+        models.Attendance.date,
+        models.Attendance.student_count,
+        func.count(models.Attendance.id)
+    ).filter(
+        models.Attendance.date >= start_date,
+        models.Attendance.date <= end_date
+    ).group_by(models.Attendance.teacher_id, models.Attendance.date, models.Attendance.student_count).all()
+
+    distribution = Counter()
+    for teacher_id, day, count, sessions in grouped:
+        distribution[(teacher_id, day.year, day.month, count)] += sessions
+    return [(*key, sessions) for key, sessions in distribution.items()]
+
+
+def simulate_rule_changes(
+    db: Session,
+    start_date: date,
+    end_date: date,
+    candidates: List[List[Dict]],
+    rules_by_month: Dict[Tuple[int, int], List[Dict]]
+) -> Dict:
+    """
+    試算候選級距規則對期間內上課薪資的影響
+    - 以 GROUP BY (教練, 年, 月, 人數) 只載入一次人數分布
+    - 每組規則展開成查表陣列，以陣列索引一次算完所有紀錄
+    - 基準為各月份實際適用的規則 (rules_by_month)
+    回傳每組候選規則的總額、各教練金額與相對基準的差額
+    """
+    grouped = _student_count_distribution(db, start_date, end_date)
+
+    teacher_map = {t.id: t.name for t in db.query(models.Teacher.id, models.Teacher.name).all()}
+    teacher_ids = sorted({row[0] for row in grouped})
+    teacher_index = {tid: i for i, tid in enumerate(teacher_ids)}
+    month_keys = sorted(rules_by_month)
+    month_index = {key: i for i, key in enumerate(month_keys)}
+
+    if grouped:
+        teacher_idx = np.array([teacher_index[row[0]] for row in grouped])
+        month_idx = np.array([month_index[(int(row[1]), int(row[2]))] for row in grouped])
+        counts = np.array([max(int(row[3]), 0) for row in grouped])
+        sessions = np.array([row[4] for row in grouped], dtype=float)
+        max_count = int(counts.max())
+    else:
+        teacher_idx = month_idx = counts = sessions = np.array([], dtype=int)
+        max_count = 0
+
+    def per_teacher(amounts: np.ndarray) -> np.ndarray:
+        return np.bincount(teacher_idx, weights=amounts * sessions, minlength=len(teacher_ids))
+
+    # 基準：各月份實際適用的規則 (二維查表 [月份, 人數])
+    baseline_table = np.vstack([_tier_table(rules_by_month[key], max_count) for key in month_keys])
+    baseline = per_teacher(baseline_table[month_idx, counts]) if len(counts) else np.zeros(len(teacher_ids))
+
+    results = []
+    for i, tiers in enumerate(candidates):
+        table = _tier_table(tiers, max_count)
+        amounts = per_teacher(table[counts]) if len(counts) else np.zeros(len(teacher_ids))
+        deltas = amounts - baseline
+        results.append({
+            "index": i,
+            "total": float(amounts.sum()),
+            "delta": float(deltas.sum()),
+            "teachers": [
+                {
+                    "teacher_id": tid,
+                    "teacher_name": teacher_map.get(tid, "未知教練"),
+                    "baseline": float(baseline[j]),
+                    "amount": float(amounts[j]),
+                    "delta": float(deltas[j])
+                }
+                for j, tid in enumerate(teacher_ids)
+            ]
+        })
+
+    return {
+        "start_date": start_date,
+        "end_date": end_date,
+        "baseline_total": float(baseline.sum()),
+        "candidates": results
+    }
+
+
+def months_between(start_date: date, end_date: date) -> List[Tuple[int, int]]:
+    """期間內涵蓋的 (年, 月) 清單"""
+    months = []
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def _payroll_cell(base_salary: float, commission: float) -> Dict:
+    return {"base_salary": base_salary, "commission": commission, "total": base_salary + commission}
+
+
+def compute_range_payroll(
+    db: Session,
+    months: List[Tuple[int, int]],
+    rules_by_month: Dict[Tuple[int, int], List[Dict]],
+    frozen: Dict[Tuple[int, int], List[models.MonthlyPayroll]]
+) -> Dict:
+    """
+    計算多個月份的教練 × 月份薪資矩陣 (每個月份依各自的規則)
+    - 未關帳月份：整個期間只查一次人數分布與一次提成合計，依各月規則查表計算
+    - 已關帳月份 (frozen)：直接使用凍結結果，不重算
+    與 compute_month_payroll 相同，只列出期間總額大於 0 的教練
+    """
+    start_date = month_range(*months[0])[0]
+    end_date = month_range(*months[-1])[1]
+    month_index = {key: i for i, key in enumerate(months)}
+    open_months = {key for key in months if key not in frozen}
+
+    teacher_map = {t.id: t.name for t in db.query(models.Teacher.id, models.Teacher.name).all()}
+    names = dict(teacher_map)
+    for rows in frozen.values():
+        for row in rows:
+            names.setdefault(row.teacher_id, row.teacher_name)
+    teacher_ids = sorted(names)
+    teacher_index = {tid: i for i, tid in enumerate(teacher_ids)}
+    base = np.zeros((len(teacher_ids), len(months)))
+    commission = np.zeros((len(teacher_ids), len(months)))
+
+    if open_months:
+        # 上課薪資：(教練, 月份, 人數) 分布 × 各月查表
+        grouped = [
+            row for row in _student_count_distribution(db, start_date, end_date)
+            if row[0] in teacher_map and (int(row[1]), int(row[2])) in open_months
+        ]
+        if grouped:
+            teacher_idx = np.array([teacher_index[row[0]] for row in grouped])
+            month_idx = np.array([month_index[(int(row[1]), int(row[2]))] for row in grouped])
+            counts = np.array([max(int(row[3]), 0) for row in grouped])
+            sessions = np.array([row[4] for row in grouped], dtype=float)
+            tables = np.vstack([_tier_table(rules_by_month.get(key, []), int(counts.max())) for key in months])
+            np.add.at(base, (teacher_idx, month_idx), tables[month_idx, counts] * sessions)
+
+        # 銷售提成：沿用紀錄中的 commission
+        year_col = extract("year", models.Sales.date)
+        month_col = extract("month", models.Sales.date)
+        sales = db.query(
+            models.Sales.teacher_id,
+            year_col,
+            month_col,
+            func.sum(models.Sales.commission)
+        ).filter(
+            models.Sales.date >= start_date,
+            models.Sales.date <= end_date
+        ).group_by(models.Sales.teacher_id, year_col, month_col).all()
+        for tid, year, month, total in sales:
+            key = (int(year), int(month))
+            if tid in teacher_map and key in open_months and total:
+                commission[teacher_index[tid], month_index[key]] += float(total)
+
+    for key, rows in frozen.items():
+        for row in rows:
+            base[teacher_index[row.teacher_id], month_index[key]] = row.base_salary
+            commission[teacher_index[row.teacher_id], month_index[key]] = row.commission
+
+    totals = base + commission
+    rows = [
+        {
+            "teacher_id": tid,
+            "teacher_name": names[tid],
+            "months": [_payroll_cell(float(base[i, j]), float(commission[i, j])) for j in range(len(months))],
+            **_payroll_cell(float(base[i].sum()), float(commission[i].sum()))
+        }
+        for i, tid in enumerate(teacher_ids) if totals[i].sum() > 0
+    ]
+    rows.sort(key=lambda r: r["total"], reverse=True)
+
+    return {
+        "months": [{"year": year, "month": month, "closed": (year, month) in frozen} for year, month in months],
+        "rows": rows,
+        "totals": [_payroll_cell(float(base[:, j].sum()), float(commission[:, j].sum())) for j in range(len(months))],
+        "total": _payroll_cell(float(base.sum()), float(commission.sum()))
+    }
@@ -0,0 +1,154 @@
+"""
+彙總報表模組
+========================
+GET /reports/aggregate 的查詢編譯：以白名單的指標 (metrics) 與分組維度 (group_by)
+組成單一 SQL GROUP BY，日期區間直接下推到 WHERE，
+日/週/月/星期分組依資料庫方言 (SQLite / PostgreSQL) 產生對應的日期函數。
+結果由 app.cache 依資料版本快取，資料未變動時重複查詢不再打資料庫。
+"""
+from datetime import date
+from typing import Dict, List, Optional
+
+from sqlalchemy import Date, Float, Integer, cast, extract, func, literal_column, select
+from sqlalchemy.orm import Session
+
+from . import models
+
+# 指標白名單：名稱 -> (資料來源, 聚合運算式)
+METRICS = {
+    "classes": ("attendance", func.count(models.Attendance.id)),
+    "students": ("attendance", func.sum(models.Attendance.student_count)),
+    "avg_students": ("attendance", cast(func.avg(models.Attendance.student_count), Float)),
+    "salary": ("attendance", func.sum(models.Attendance.calculated_salary)),
+    "sales": ("sales", func.count(models.Sales.id)),
+    "amount": ("sales", func.sum(models.Sales.amount)),
+    "commission": ("sales", func.sum(models.Sales.commission)),
+}
+
+# 各資料來源的主表
+SOURCES = {
+    "attendance": models.Attendance,
+    "sales": models.Sales,
+}
+
+# 日期分組維度
+DATE_DIMENSIONS = ("day", "week", "month", "weekday")
+
+
+def _or_unknown(column, placeholder: str):
+    """關聯已刪除或未設定時以 placeholder 代替 (以字面值寫入 SQL，SELECT 與 GROUP BY 的運算式才會一致)"""
+    return func.coalesce(column, literal_column(f"'{placeholder}'"))
+
+
+# 關聯維度：名稱 -> {資料來源: (輸出欄位, 需要 join 的表與條件)}
+# 以 LEFT JOIN 加入，教練/課程已刪除的紀錄歸到「未知」分組，不會從合計中消失
+RELATION_DIMENSIONS = {
+    "teacher": {
+        "attendance": (
+            [models.Attendance.teacher_id.label("teacher_id"), _or_unknown(models.Teacher.name, "未知教練").label("teacher_name")],
+            (models.Teacher, models.Attendance.teacher_id == models.Teacher.id),
+        ),
+        "sales": (
+            [models.Sales.teacher_id.label("teacher_id"), _or_unknown(models.Teacher.name, "未知教練").label("teacher_name")],
+            (models.Teacher, models.Sales.teacher_id == models.Teacher.id),
+        ),
+    },
+    "course": {
+        "attendance": (
+            [models.Attendance.course_id.label("course_id"), _or_unknown(models.Course.name, "未知課程").label("course_name")],
+            (models.Course, models.Attendance.course_id == models.Course.id),
+        ),
+    },
+    "course_type": {
+        "attendance": (
+            [_or_unknown(models.Course.course_type, "未知類型").label("course_type")],
+            (models.Course, models.Attendance.course_id == models.Course.id),
+        ),
+    },
+}
+
+DIMENSIONS = tuple(RELATION_DIMENSIONS) + DATE_DIMENSIONS
+
+
+def _parse_names(value: Optional[str]) -> List[str]:
+    return list(dict.fromkeys(name.strip() for name in (value or "").split(",") if name.strip()))
+
+
+def date_bucket(dimension: str, column, dialect: str):
+    """日期分組運算式 (週以星期一為起始；星期為 ISO 1=週一 ... 7=週日)"""
+    if dialect == "sqlite":
+        if dimension == "day":
+            return column
+        if dimension == "week":
+            return func.date(column, "-6 days", "weekday 1")
+        if dimension == "month":
+            return func.strftime("%Y-%m", column)
+        # %w：0=週日 ... 6=週六
+        return (cast(func.strftime("%w", column), Integer) + 6) % 7 + 1
+    if dimension == "day":
+        return column
+    if dimension == "week":
+        return cast(func.date_trunc("week", column), Date)
+    if dimension == "month":
+        return func.to_char(column, "YYYY-MM")
+    return cast(extract("isodow", column), Integer)
+
+
+def build_aggregate_query(
+    metrics: str,
+    group_by: Optional[str],
+    start_date: Optional[date],
+    end_date: Optional[date],
+    teacher_id: Optional[int],
+    dialect: str
+):
+    """
+    將 metrics / group_by 編譯成單一 GROUP BY 查詢
+    未知或不相容的指標/維度拋出 ValueError
+    """
+    metric_names = _parse_names(metrics)
+    if not metric_names:
+        raise ValueError("至少需要一個指標")
+    unknown = [name for name in metric_names if name not in METRICS]
+    if unknown:
+        raise ValueError(f"未知指標: {', '.join(unknown)} (可用: {', '.join(METRICS)})")
+    sources = {METRICS[name][0] for name in metric_names}
+    if len(sources) > 1:
+        raise ValueError("上課與賣課指標不可混用於同一個查詢")
+    source = sources.pop()
+    model = SOURCES[source]
+
+    dimension_names = _parse_names(group_by)
+    unknown = [name for name in dimension_names if name not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f"未知分組: {', '.join(unknown)} (可用: {', '.join(DIMENSIONS)})")
+
+    group_columns = []
+    joins = {}
+    for name in dimension_names:
+        if name in DATE_DIMENSIONS:
+            group_columns.append(date_bucket(name, model.date, dialect).label(name))
+            continue
+        if source not in RELATION_DIMENSIONS[name]:
+            raise ValueError(f"分組 {name} 不適用於{'賣課' if source == 'sales' else '上課'}指標")
+        columns, (target, onclause) = RELATION_DIMENSIONS[name][source]
+        group_columns.extend(columns)
+        joins[target] = onclause
+
+    stmt = select(*group_columns, *[METRICS[name][1].label(name) for name in metric_names]).select_from(model)
+    for target, onclause in joins.items():
+        stmt = stmt.outerjoin(target, onclause)
+    if start_date:
+        stmt = stmt.where(model.date >= start_date)
+    if end_date:
+        stmt = stmt.where(model.date <= end_date)
+    if teacher_id is not None:
+        stmt = stmt.where(model.teacher_id == teacher_id)
+    if group_columns:
+        stmt = stmt.group_by(*group_columns).order_by(*group_columns)
+    return stmt
+
+
+def run_aggregate(db: Session, stmt) -> List[Dict]:
+    """執行彙總查詢 (結果快取由呼叫端依資料版本處理)"""
+    return [dict(row._mapping) for row in db.execute(stmt)]
@@ -2,11 +2,16 @@
 薪資計算規則模組
 ========================
 此模組包含所有薪資與提成計算邏輯
-支援動態修改與持久化儲存 (JSON)
+規則存放於資料庫 (多 worker 共用，以版本號同步)，
+salary_rules.json 僅作為初始值與本機備份 (原子寫入)
 """
 import json
 import os
-from typing import List, Dict
+import tempfile
+from typing import List, Dict, Optional
+
+from .database import SessionLocal
+from .shared_state import RULES_KEY, VersionedSetting, set_setting
 
 RULES_FILE = "salary_rules.json"
 
@@ -18,16 +23,24 @@ DEFAULT_TIERS = [
     {"min": 16, "max": 99999, "amount": 1500}, # 16 人以上：$1500
 ]
 
+# 方案目錄：售價與固定提成金額（每個）
+PLAN_CATALOG = [
+    {"code": "方案A", "name": "入門方案", "price": 3000, "commission": 100},  # 提成固定 $100
+    {"code": "方案B", "name": "進階方案", "price": 5000, "commission": 200},  # 提成固定 $200
+    {"code": "方案C", "name": "專業方案", "price": 8000, "commission": 300},  # 提成固定 $300
+]
+
 # 固定提成金額（每個）
-COMMISSION_RATES = {
-    "方案A": 100,  # 固定 $100
-    "方案B": 200,  # 固定 $200
-    "方案C": 300,  # 固定 $300
-}
+COMMISSION_RATES = {plan["code"]: plan["commission"] for plan in PLAN_CATALOG}
 
+# 賣課明細的特殊方案代碼
+SPECIAL_PLAN = "特殊金額"  # 自訂金額 (無提成)
+UNCLASSIFIED_PLAN = "未分類"  # 歷史紀錄無法拆解的部分
+MAX_INFERRED_QUANTITY = 100  # 由金額反推明細時每個方案的數量上限 (限制搜尋量)
 
-def load_rules() -> List[Dict]:
-    """讀取薪資規則 (如有 JSON 則讀取，否則回傳預設值)"""
+
+def _load_rules_file() -> List[Dict]:
+    """讀取 JSON 規則檔 (不存在或損毀時回傳預設值)"""
     if os.path.exists(RULES_FILE):
         try:
             with open(RULES_FILE, "r", encoding="utf-8") as f:
@@ -37,21 +50,44 @@ def load_rules() -> List[Dict]:
     return DEFAULT_TIERS
 
 
-def save_rules(tiers: List[Dict]):
-    """儲存薪資規則到 JSON"""
-    with open(RULES_FILE, "w", encoding="utf-8") as f:
-        json.dump(tiers, f, indent=2, ensure_ascii=False)
+def _write_rules_file(tiers: List[Dict]):
+    """原子寫入 JSON 規則檔 (先寫暫存檔再 rename，避免讀到寫一半的檔案)"""
+    directory = os.path.dirname(os.path.abspath(RULES_FILE))
+    fd, tmp_path = tempfile.mkstemp(prefix=".salary_rules.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(tiers, f, indent=2, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, RULES_FILE)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 
-def calculate_salary(student_count: int) -> float:
-    """
-    根據上課人數計算薪資
-    """
-    if student_count < 1:
-        raise ValueError("上課人數必須至少為 1 人")
-    
-    tiers = load_rules()
-    
+# 資料庫尚無規則時，以 JSON 檔 (或預設值) 初始化
+_rules = VersionedSetting(RULES_KEY, _load_rules_file)
+
+
+def load_rules() -> List[Dict]:
+    """讀取目前薪資規則 (程序內快取，定期比對資料庫版本)"""
+    return _rules.get()
+
+
+def save_rules(tiers: List[Dict], db=None):
+    """儲存薪資規則到資料庫 (遞增版本) 並原子寫入 JSON 備份"""
+    if db is not None:
+        set_setting(db, RULES_KEY, tiers)
+    else:
+        with SessionLocal() as session:
+            set_setting(session, RULES_KEY, tiers)
+    _rules.invalidate()
+    _write_rules_file(tiers)
+
+
+def lookup_tier_amount(student_count: int, tiers: List[Dict]) -> float:
+    """依指定規則查表取得薪資 (不做人數檢查，供月結/重算使用)"""
     for tier in tiers:
         if tier["min"] <= student_count <= tier["max"]:
             return float(tier["amount"])
@@ -62,6 +98,20 @@ def calculate_salary(student_count: int) -> float:
     return 0.0
 
 
+def calculate_salary(student_count: int, tiers: Optional[List[Dict]] = None) -> float:
+    """
+    根據上課人數計算薪資
+    (未指定 tiers 時使用目前規則)
+    """
+    if student_count < 1:
+        raise ValueError("上課人數必須至少為 1 人")
+    
+    if tiers is None:
+        tiers = load_rules()
+    
+    return lookup_tier_amount(student_count, tiers)
+
+
 def calculate_commission(plan_type: str, amount: float) -> float:
     """根據方案類型與金額計算提成"""
     if plan_type not in COMMISSION_RATES:
@@ -72,3 +122,91 @@ def calculate_commission(plan_type: str, amount: float) -> float:
     
     rate = COMMISSION_RATES[plan_type]
     return amount * rate
+
+
+class SaleItemsLimitError(ValueError):
+    """金額超出自動推算明細的範圍 (需由呼叫端附上明細)"""
+
+
+def _solve_quantities(plans: List[Dict], revenue: float, commission: Optional[float]) -> Optional[List[int]]:
+    """
+    找出每個方案的數量 (各介於 1 與 MAX_INFERRED_QUANTITY)，使售價合計等於 revenue；
+    commission 不為 None 時提成合計也須相符
+    只列舉前面幾個方案的數量，最後一個方案由剩餘金額直接算出，
+    搜尋量最多 MAX_INFERRED_QUANTITY ** (方案數 - 1)，與金額大小無關
+    """
+    *head, last = plans
+    if last["price"] <= 0:
+        return None
+
+    def search(index: int, remaining: float, remaining_commission: float) -> Optional[List[int]]:
+        if index == len(head):
+            qty = round(remaining / last["price"])
+            if not 1 <= qty <= MAX_INFERRED_QUANTITY or abs(remaining - qty * last["price"]) >= 0.5:
+                return None
+            if commission is not None and abs(remaining_commission - qty * last["commission"]) >= 0.5:
+                return None
+            return [qty]
+        plan = head[index]
+        max_qty = min(MAX_INFERRED_QUANTITY, int(remaining // plan["price"])) if plan["price"] > 0 else 1
+        for qty in range(1, max_qty + 1):
+            rest = search(index + 1, remaining - qty * plan["price"], remaining_commission - qty * plan["commission"])
+            if rest is not None:
+                return [qty] + rest
+        return None
+
+    return search(0, revenue, commission or 0.0)
+
+
+def check_inference_limit(plan_type: str, amount: float, custom_amount: Optional[float]):
+    """未附明細的新增請求：金額需要的數量超過推算上限時拋出 SaleItemsLimitError"""
+    tokens = [token.strip() for token in (plan_type or "").split("+")]
+    prices = [plan["price"] for plan in PLAN_CATALOG if plan["code"] in tokens]
+    revenue = float(amount or 0) - float(custom_amount or 0)
+    if prices and revenue > sum(prices) * MAX_INFERRED_QUANTITY:
+        raise SaleItemsLimitError(
+            f"金額 {amount:,.0f} 超出自動推算明細的範圍 (每個方案最多 {MAX_INFERRED_QUANTITY} 份)，請附上 items 明細"
+        )
+
+
+def infer_sale_items(plan_type: str, amount: float, custom_amount: Optional[float], commission: Optional[float]) -> List[Dict]:
+    """
+    由舊格式的賣課紀錄推算明細 (供歷史資料回填與未附明細的請求使用)
+    plan_type 例如 "方案A + 方案B + 特殊金額"；數量以方案目錄的售價/提成反推，
+    無法唯一對應時整筆記為「未分類」，確保明細金額與提成合計與原紀錄一致
+    """
+    custom_amount = float(custom_amount or 0)
+    commission = float(commission or 0)
+    revenue = float(amount or 0) - custom_amount
+    tokens = [token.strip() for token in (plan_type or "").split("+")]
+    catalog = {plan["code"]: plan for plan in PLAN_CATALOG}
+    plans = [catalog[code] for code in dict.fromkeys(tokens) if code in catalog]
+
+    items = []
+    if custom_amount > 0:
+        items.append({"plan": SPECIAL_PLAN, "quantity": 1, "unit_price": custom_amount, "unit_commission": 0.0})
+
+    if plans and revenue > 0:
+        quantities = _solve_quantities(plans, revenue, commission)
+        if quantities is not None:
+            for plan, qty in zip(plans, quantities):
+                items.append({"plan": plan["code"], "quantity": qty, "unit_price": float(plan["price"]), "unit_commission": float(plan["commission"])})
+            return items
+        quantities = _solve_quantities(plans, revenue, None)
+        if quantities is not None:
+            # 售價對得上但提成不符 (舊版提成算法)：依目錄提成比例分攤實際提成
+            catalog_commission = sum(plan["commission"] * qty for plan, qty in zip(plans, quantities))
+            scale = commission / catalog_commission if catalog_commission else 0.0
+            for plan, qty in zip(plans, quantities):
+                items.append({"plan": plan["code"], "quantity": qty, "unit_price": float(plan["price"]), "unit_commission": plan["commission"] * scale})
+            return items
+
+    if revenue > 0 or commission > 0 or not items:
+        if len(plans) == 1:
+            plan = plans[0]["code"]
+        elif not plans and plan_type and plan_type != SPECIAL_PLAN:
+            plan = plan_type  # 目錄外的舊方案名稱
+        else:
+            plan = UNCLASSIFIED_PLAN
+        items.append({"plan": plan, "quantity": 1, "unit_price": max(revenue, 0.0), "unit_commission": commission})
+    return items
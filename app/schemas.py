@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field
-from datetime import date as Date
-from typing import Optional
+from datetime import date as Date, datetime
+from typing import Literal, Optional
 
 
 # ========== Teacher Schemas ==========
@@ -45,7 +45,7 @@ class AttendanceBase(BaseModel):
 
 
 class AttendanceCreate(AttendanceBase):
-    pass
+    idempotency_key: Optional[str] = Field(None, max_length=64, description="冪等鍵：同一個鍵重送時回傳既有紀錄，不重複建立")
 
 
 class Attendance(AttendanceBase):
@@ -56,7 +56,33 @@ class Attendance(AttendanceBase):
         from_attributes = True
 
 
+class AttendanceExpanded(Attendance):
+    """列表回應 (expand=teacher,course 時附帶名稱)"""
+    teacher_name: Optional[str] = Field(None, description="教練姓名 (expand=teacher)")
+    course_name: Optional[str] = Field(None, description="課程名稱 (expand=course)")
+    course_type: Optional[str] = Field(None, description="課程類型 (expand=course)")
+
+
 # ========== Sales Schemas ==========
+class SaleItemBase(BaseModel):
+    plan: str = Field(..., description="方案代碼，例如 方案A；特殊金額為 特殊金額")
+    quantity: int = Field(..., ge=1, description="數量")
+    unit_price: float = Field(..., ge=0, description="單價")
+    unit_commission: float = Field(0, ge=0, description="單位提成")
+
+
+class SaleItemCreate(SaleItemBase):
+    pass
+
+
+class SaleItem(SaleItemBase):
+    id: int
+    sales_id: int
+    
+    class Config:
+        from_attributes = True
+
+
 class SalesBase(BaseModel):
     date: Date = Field(..., description="銷售日期")
     teacher_id: int = Field(..., description="教練 ID")
@@ -68,7 +94,8 @@ class SalesBase(BaseModel):
 
 
 class SalesCreate(SalesBase):
-    pass
+    items: Optional[list[SaleItemCreate]] = Field(None, description="賣課明細 (未提供時由 plan_type 與金額推算)")
+    idempotency_key: Optional[str] = Field(None, max_length=64, description="冪等鍵：同一個鍵重送時回傳既有紀錄，不重複建立")
 
 
 class Sales(SalesBase):
@@ -80,6 +107,16 @@ class Sales(SalesBase):
         from_attributes = True
 
 
+class SalesDetail(Sales):
+    """單筆賣課紀錄 (含明細)"""
+    items: list[SaleItem] = Field(default_factory=list, description="賣課明細")
+
+
+class SalesExpanded(Sales):
+    """列表回應 (expand=teacher 時附帶名稱)"""
+    teacher_name: Optional[str] = Field(None, description="教練姓名 (expand=teacher)")
+
+
 # ========== Admin Schemas ==========
 class SalaryTier(BaseModel):
     min: int = Field(..., ge=0, description="最小人數")
@@ -97,3 +134,160 @@ class MonthlyStats(BaseModel):
     total_revenue: float
     total_expenses: float
     net_income: float
+
+
+# ========== Payroll Close Schemas ==========
+class PayrollRow(BaseModel):
+    teacher_id: int
+    teacher_name: str
+    base_salary: float = Field(..., description="上課薪資")
+    commission: float = Field(..., description="銷售提成")
+    total: float = Field(..., description="總薪資")
+    
+    class Config:
+        from_attributes = True
+
+
+class ClosedPayroll(BaseModel):
+    year: int
+    month: int
+    content_hash: str = Field(..., description="關帳內容雜湊 (原始紀錄 + 規則)")
+    closed_at: datetime
+    tiers: list[SalaryTier] = Field(..., description="關帳時使用的薪資級距")
+    rows: list[PayrollRow]
+
+
+class PayrollCell(BaseModel):
+    base_salary: float = Field(..., description="上課薪資")
+    commission: float = Field(..., description="銷售提成")
+    total: float = Field(..., description="總薪資")
+
+
+class PayrollRangeMonth(BaseModel):
+    year: int
+    month: int
+    closed: bool = Field(..., description="已關帳 (使用凍結結果)")
+
+
+class PayrollRangeRow(PayrollCell):
+    teacher_id: int
+    teacher_name: str
+    months: list[PayrollCell] = Field(..., description="各月份薪資 (順序同 PayrollRange.months)")
+
+
+class PayrollRange(BaseModel):
+    start: str = Field(..., description="起始月份 YYYY-MM")
+    end: str = Field(..., description="結束月份 YYYY-MM")
+    months: list[PayrollRangeMonth]
+    rows: list[PayrollRangeRow] = Field(..., description="每位教練一列 (依期間總薪資排序)")
+    totals: list[PayrollCell] = Field(..., description="各月份合計")
+    total: PayrollCell = Field(..., description="期間合計")
+
+
+# ========== Bootstrap Schemas ==========
+class Plan(BaseModel):
+    code: str = Field(..., description="方案代碼，例如 方案A")
+    name: str = Field(..., description="方案名稱")
+    price: float = Field(..., description="售價")
+    commission: float = Field(..., description="每份固定提成")
+
+
+class Bootstrap(BaseModel):
+    version: str = Field(..., description="資料版本 (同 ETag)")
+    teachers: list[Teacher]
+    courses: list[Course]
+    plans: list[Plan]
+    tiers: list[SalaryTier]
+
+
+# ========== Rule Simulation Schemas ==========
+class RuleSimulationRequest(BaseModel):
+    start_date: Date = Field(..., description="起始日期")
+    end_date: Date = Field(..., description="結束日期")
+    candidates: list[list[SalaryTier]] = Field(..., min_length=1, description="候選級距規則 (可多組)")
+
+
+class TeacherSimulation(BaseModel):
+    teacher_id: int
+    teacher_name: str
+    baseline: float = Field(..., description="現行規則下的上課薪資")
+    amount: float = Field(..., description="候選規則下的上課薪資")
+    delta: float = Field(..., description="差額 (候選 - 現行)")
+
+
+class CandidateSimulation(BaseModel):
+    index: int = Field(..., description="候選規則序號 (對應請求順序)")
+    total: float
+    delta: float
+    teachers: list[TeacherSimulation]
+
+
+class RuleSimulationResult(BaseModel):
+    start_date: Date
+    end_date: Date
+    baseline_total: float = Field(..., description="現行規則下的上課薪資總額")
+    candidates: list[CandidateSimulation]
+
+
+# ========== Report Schemas ==========
+class PlanSalesReport(BaseModel):
+    plan: str = Field(..., description="方案代碼")
+    quantity: int = Field(..., description="售出數量")
+    revenue: float = Field(..., description="營收")
+    commission: float = Field(..., description="提成")
+
+
+# ========== Teacher Earnings Schemas ==========
+class EarningItem(BaseModel):
+    date: Date
+    kind: str = Field(..., description="attendance (上課) 或 sales (賣課)")
+    record_id: int
+    description: str = Field(..., description="課程名稱或方案內容")
+    student_count: Optional[int] = Field(None, description="上課人數 (僅上課紀錄)")
+    base: float = Field(..., description="上課薪資")
+    commission: float = Field(..., description="銷售提成")
+    mtd_base: float = Field(..., description="當月累計上課薪資 (自該月 1 號起，不受查詢起日影響)")
+    mtd_commission: float = Field(..., description="當月累計提成")
+    mtd_total: float = Field(..., description="當月累計總額")
+
+
+class TeacherEarnings(BaseModel):
+    teacher_id: int
+    teacher_name: str
+    start_date: Date
+    end_date: Date
+    base: float = Field(..., description="期間上課薪資合計")
+    commission: float = Field(..., description="期間提成合計")
+    total: float = Field(..., description="期間總額")
+    total_items: int = Field(..., description="期間明細總筆數 (分頁用)")
+    skip: int
+    limit: int
+    items: list[EarningItem]
+
+
+# ========== Month Sync Schemas ==========
+class MonthSync(BaseModel):
+    seq: int = Field(..., description="本次同步到的異動序號 (下次以 since 帶回)")
+    full: bool = Field(..., description="true 表示完整快照，前端應整月取代；false 為增量")
+    attendances: list[dict] = Field(default_factory=list, description="新增 (或完整) 的上課紀錄")
+    sales: list[dict] = Field(default_factory=list, description="新增 (或完整) 的賣課紀錄")
+    deleted_attendances: list[int] = Field(default_factory=list, description="已刪除的上課紀錄 id")
+    deleted_sales: list[int] = Field(default_factory=list, description="已刪除的賣課紀錄 id")
+
+
+# ========== Submission Batch Schemas ==========
+class SubmissionItem(BaseModel):
+    kind: Literal["attendance", "sales"] = Field(..., description="attendance (上課) 或 sales (賣課)")
+    idempotency_key: str = Field(..., min_length=1, max_length=64, description="冪等鍵 (前端送出佇列產生)")
+    data: dict = Field(..., description="AttendanceCreate 或 SalesCreate 的內容")
+
+
+class SubmissionBatch(BaseModel):
+    items: list[SubmissionItem] = Field(..., min_length=1, max_length=100)
+
+
+class SubmissionResult(BaseModel):
+    idempotency_key: str
+    status: Literal["created", "duplicate", "rejected"] = Field(..., description="rejected 表示資料本身有誤，重送也不會成功")
+    id: Optional[int] = Field(None, description="紀錄 ID (created/duplicate)")
+    detail: Optional[str] = Field(None, description="rejected 的原因")
@@ -0,0 +1,165 @@
+"""
+多 worker 共用狀態模組
+========================
+薪資規則等共用設定存放在資料庫 system_settings 表，每次寫入遞增 version。
+各 worker 以程序內快取保存內容，只在輪詢間隔到期時查一次 version (單一主鍵查詢)，
+版本不同才重新載入，確保多個 worker 之間的資料一致。
+"""
+import json
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from decouple import config
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal
+
+# 版本輪詢間隔 (秒)：其他 worker 寫入後最多延遲這麼久才會看到新值
+VERSION_POLL_SECONDS = config("VERSION_POLL_SECONDS", default=2.0, cast=float)
+
+# 共用設定鍵值
+RULES_KEY = "salary_tiers"
+REFERENCE_KEY = "reference_data"  # 教練/課程等參考資料 (只用 version)
+DATA_KEY_PREFIX = "data:"  # 每月上課/賣課資料版本，例如 data:2025-03 (value 記錄是否已關帳)
+
+# 支援 INSERT ... ON CONFLICT 的資料庫方言 (其他資料庫改用先 UPDATE 再 INSERT)
+UPSERT_INSERTS = {"postgresql": postgresql_insert, "sqlite": sqlite_insert}
+
+
+def get_version(db: Session, key: str) -> Optional[int]:
+    """取得設定版本 (不存在回傳 None)"""
+    return db.query(models.SystemSetting.version).filter(models.SystemSetting.key == key).scalar()
+
+
+def get_settings(db: Session, keys: list) -> Dict[str, models.SystemSetting]:
+    """一次取得多個設定 (單一查詢)"""
+    rows = db.query(models.SystemSetting).filter(models.SystemSetting.key.in_(keys)).all()
+    return {row.key: row for row in rows}
+
+
+def get_setting(db: Session, key: str) -> Optional[models.SystemSetting]:
+    """取得設定"""
+    return db.query(models.SystemSetting).filter(models.SystemSetting.key == key).first()
+
+
+def set_setting(db: Session, key: str, value: Any, commit: bool = True) -> int:
+    """寫入設定 (JSON) 並遞增版本，回傳新版本號"""
+    value_json = json.dumps(value, ensure_ascii=False)
+    db_setting = get_setting(db, key)
+    if db_setting is None:
+        db_setting = models.SystemSetting(key=key, value=value_json, version=1)
+        db.add(db_setting)
+    else:
+        db_setting.value = value_json
+        db_setting.version = models.SystemSetting.version + 1
+    if commit:
+        db.commit()
+    else:
+        db.flush()
+    return get_version(db, key)
+
+
+def bump_version(db: Session, key: str, commit: bool = True):
+    """
+    只遞增版本 (用於資料本身在其他資料表的情況，例如教練/課程)
+    以 INSERT ... ON CONFLICT DO UPDATE 一次完成：新月份第一次寫入時多個請求同時插入也不會衝突
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect in UPSERT_INSERTS:
+        stmt = UPSERT_INSERTS[dialect](models.SystemSetting).values(key=key, value=None, version=1, updated_at=datetime.now())
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[models.SystemSetting.key],
+            set_={"version": models.SystemSetting.version + 1, "updated_at": stmt.excluded.updated_at}
+        ))
+    else:
+        updated = db.query(models.SystemSetting).filter(models.SystemSetting.key == key).update(
+            {models.SystemSetting.version: models.SystemSetting.version + 1},
+            synchronize_session=False
+        )
+        if not updated:
+            db.add(models.SystemSetting(key=key, value=None, version=1))
+    if commit:
+        db.commit()
+
+
+def data_key(year: int, month: int) -> str:
+    """每月資料版本的設定鍵值"""
+    return f"{DATA_KEY_PREFIX}{year:04d}-{month:02d}"
+
+
+def get_month_states(db: Session, months: Iterable[Tuple[int, int]]) -> Dict[Tuple[int, int], Tuple[int, bool]]:
+    """一次取得多個月份的 (資料版本, 是否已關帳)；尚無紀錄的月份為 (0, False)"""
+    months = list(months)
+    settings = get_settings(db, [data_key(year, month) for year, month in months])
+    states = {}
+    for year, month in months:
+        db_setting = settings.get(data_key(year, month))
+        if db_setting is None:
+            states[(year, month)] = (0, False)
+        else:
+            value = json.loads(db_setting.value) if db_setting.value else {}
+            states[(year, month)] = (db_setting.version, bool(value.get("closed")))
+    return states
+
+
+def get_total_data_version(db: Session) -> int:
+    """所有月份資料版本的總和 (任何月份變動都會增加，供不限期間的查詢使用)"""
+    return db.query(func.coalesce(func.sum(models.SystemSetting.version), 0)).filter(
+        models.SystemSetting.key.like(f"{DATA_KEY_PREFIX}%")
+    ).scalar()
+
+
+class VersionedSetting:
+    """
+    以資料庫版本號同步的程序內快取
+    default_factory: 資料庫尚無此設定時的初始值 (會寫入資料庫作為版本 1)
+    """
+
+    def __init__(self, key: str, default_factory: Callable[[], Any], poll_seconds: float = VERSION_POLL_SECONDS):
+        self.key = key
+        self.default_factory = default_factory
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._value: Any = None
+        self._version: Optional[int] = None
+        self._checked_at = 0.0
+
+    def get(self) -> Any:
+        with self._lock:
+            now = time.monotonic()
+            if self._version is not None and now - self._checked_at < self.poll_seconds:
+                return self._value
+            try:
+                self._refresh()
+            except SQLAlchemyError:
+                # 資料庫暫時無法使用 (或尚未建表)：沿用快取，沒有快取則使用預設值
+                if self._version is None:
+                    return self.default_factory()
+            self._checked_at = now
+            return self._value
+
+    def _refresh(self):
+        with SessionLocal() as db:
+            version = get_version(db, self.key)
+            if version is None:
+                # 第一次使用：以預設值初始化 (多個 worker 同時初始化時，以先寫入者為準)
+                try:
+                    set_setting(db, self.key, self.default_factory())
+                except IntegrityError:
+                    db.rollback()
+                version = get_version(db, self.key)
+            if version != self._version:
+                self._value = json.loads(get_setting(db, self.key).value)
+                self._version = version
+
+    def invalidate(self):
+        """本 worker 寫入後立即失效，下次讀取直接重新載入"""
+        with self._lock:
+            self._version = None
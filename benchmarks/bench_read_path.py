@@ -0,0 +1,85 @@
+"""
+大量讀取路徑效能比較
+========================
+比較日期區間查詢的兩種序列化路徑 (rows/sec)：
+- ORM：查詢完整 ORM 物件 → Pydantic from_attributes 驗證 → JSON (原本 response_model 的路徑)
+- Core：Core 查詢欄位 tuple → 直接 JSON (目前列表/日期區間端點的路徑)
+
+用法：python benchmarks/bench_read_path.py [筆數 ...]   (預設 10000 100000)
+使用暫存 SQLite 檔，不會動到 dexsystem.db
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from typing import List
+
+_tmpdir = tempfile.mkdtemp(prefix="dex_bench_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmpdir, 'bench.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pydantic import TypeAdapter  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+
+from app import crud, models, schemas  # noqa: E402
+from app.database import SessionLocal, engine  # noqa: E402
+from app.main import _resolve_fields, _rows_response  # noqa: E402
+from app.migrations import migrate  # noqa: E402
+
+START = date(2020, 1, 1)
+
+
+def seed(n: int):
+    with engine.begin() as conn:
+        conn.execute(models.Attendance.__table__.delete())
+        conn.execute(insert(models.Attendance), [
+            {
+                "date": START + timedelta(days=i % 1500),
+                "teacher_id": 1 + i % 7,
+                "course_id": 1 + i % 5,
+                "student_count": 1 + i % 20,
+                "calculated_salary": 500.0 + (i % 4) * 300,
+            }
+            for i in range(n)
+        ])
+
+
+def orm_path(db) -> bytes:
+    adapter = TypeAdapter(List[schemas.Attendance])
+    rows = crud.get_attendances_by_date_range(db, START, START + timedelta(days=1500))
+    validated = adapter.validate_python(rows, from_attributes=True)
+    return json.dumps(adapter.dump_python(validated, mode="json")).encode("utf-8")
+
+
+def core_path(db) -> bytes:
+    columns = _resolve_fields(models.Attendance, schemas.Attendance, None)
+    rows = crud.get_attendances_by_date_range(db, START, START + timedelta(days=1500), columns=columns)
+    return _rows_response(rows).body
+
+
+def measure(fn, n: int, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        with SessionLocal() as db:
+            t0 = time.perf_counter()
+            fn(db)
+            best = min(best, time.perf_counter() - t0)
+    return n / best
+
+
+def main(sizes):
+    migrate()
+    print(f"{'rows':>8} {'ORM rows/s':>14} {'Core rows/s':>14} {'speedup':>8}")
+    for n in sizes:
+        seed(n)
+        with SessionLocal() as db:
+            assert json.loads(orm_path(db)) == json.loads(core_path(db)), "兩種路徑輸出不一致"
+        orm = measure(orm_path, n)
+        core = measure(core_path, n)
+        print(f"{n:>8} {orm:>14,.0f} {core:>14,.0f} {core / orm:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
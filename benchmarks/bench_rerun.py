@@ -0,0 +1,130 @@
+"""
+表單互動重跑時間量測
+========================
+以 Streamlit AppTest 量測教練端表單每次點選/輸入後的伺服器端重跑時間 (毫秒)：
+- 整頁：執行整個 coach_app.py (樣式、路由、整頁表單)。
+  舊版自訂元件在值變更後會再呼叫 st.rerun()，一次點選等於兩次整頁重跑。
+- 區塊：只執行表單的 fragment 區塊，也就是目前每次點選實際重跑的範圍。
+
+用法：python benchmarks/bench_rerun.py [--app 路徑] [--repeat N]
+  比較改版前後：git show <舊版 commit>:coach_app.py > /tmp/coach_app_old.py
+                python benchmarks/bench_rerun.py --app /tmp/coach_app_old.py
+使用暫存 SQLite 檔並在背景啟動 API，不會動到 dexsystem.db
+"""
+import argparse
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+_tmpdir = tempfile.mkdtemp(prefix="dex_bench_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmpdir, 'bench.db')}"
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import requests  # noqa: E402
+import uvicorn  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+from app.main import app  # noqa: E402
+from app.migrations import migrate  # noqa: E402
+
+
+def start_api() -> str:
+    """在背景執行緒啟動 API，回傳 base URL"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{base_url}/bootstrap", timeout=1)
+            return base_url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError("API 無法啟動")
+
+
+def seed(base_url: str) -> dict:
+    for i in range(1, 9):
+        requests.post(f"{base_url}/teachers/", json={"name": f"教練{i}"}).raise_for_status()
+    for i in range(1, 13):
+        requests.post(f"{base_url}/courses/", json={"name": f"課程{i}", "course_type": "常態"}).raise_for_status()
+    return requests.get(f"{base_url}/bootstrap").json()
+
+
+def section_script(app_path: str, section: str):
+    """只執行單一 fragment 區塊 (AppTest.from_function 會以原始碼執行此函數)"""
+    import importlib.util
+
+    spec = importlib.util.spec_from_file_location("bench_coach_app", app_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    getattr(module, section)()
+
+
+def full_app(app_path: str, page: str) -> AppTest:
+    at = AppTest.from_file(app_path, default_timeout=30)
+    at.query_params["page"] = page
+    return at
+
+
+def section_app(app_path: str, section: str) -> AppTest:
+    return AppTest.from_function(section_script, args=(app_path, section), default_timeout=30)
+
+
+def measure(at: AppTest, interact, values, repeat: int) -> float:
+    """每次互動後重跑的時間中位數 (毫秒)"""
+    at.run()
+    timings = []
+    for i in range(repeat):
+        interact(at, values[i % len(values)])
+        t0 = time.perf_counter()
+        at.run()
+        timings.append((time.perf_counter() - t0) * 1000)
+        assert not at.exception, at.exception
+    return statistics.median(timings)
+
+
+def main(app_path: str, repeat: int):
+    migrate()
+    os.environ["API_BASE_URL"] = start_api()
+    bootstrap = seed(os.environ["API_BASE_URL"])
+    teachers = [t["name"] for t in bootstrap["teachers"]]
+    plan_code = bootstrap["plans"][0]["code"]
+
+    with open(app_path, encoding="utf-8") as f:
+        has_sections = "def show_class_form_section" in f.read()
+
+    scenarios = [
+        ("上課表單：選擇教練", "class_form", "show_class_form_section",
+         lambda at, v: at.radio(key="class_teacher_radio").set_value(v), teachers),
+        ("上課表單：輸入人數", "class_form", "show_class_form_section",
+         lambda at, v: at.text_input(key="class_count_tel").input(v), ["3", "12", "7"]),
+        ("賣課表單：方案數量", "sales_form", "show_sales_form_section",
+         lambda at, v: at.text_input(key=f"plan_qty_{plan_code}_tel").input(v), ["1", "2", "5"]),
+        ("賣課表單：特殊金額", "sales_form", "show_sales_form_section",
+         lambda at, v: at.text_input(key="special_amount_tel").input(v), ["500", "1200", "80"]),
+    ]
+    print(f"app: {app_path}")
+    print(f"{'互動':<16} {'整頁 ms':>10} {'區塊 ms':>10}")
+    for label, page, section, interact, values in scenarios:
+        full_ms = measure(full_app(app_path, page), interact, values, repeat)
+        if has_sections:
+            section_ms = f"{measure(section_app(app_path, section), interact, values, repeat):>10.1f}"
+        else:
+            section_ms = f"{'-':>10}"
+        print(f"{label:<16} {full_ms:>10.1f} {section_ms}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app", default=os.path.join(ROOT, "coach_app.py"), help="要量測的 coach_app.py")
+    parser.add_argument("--repeat", type=int, default=20, help="每種互動的重跑次數")
+    args = parser.parse_args()
+    main(os.path.abspath(args.app), args.repeat)
@@ -1,28 +1,14 @@
+"""
+資料庫初始化 / 遷移
+建立缺少的資料表與欄位、回填歷史資料並記錄 schema 版本
+部署時請在啟動 API 前執行：python migrate_db.py
+"""
+from app.database import SQLALCHEMY_DATABASE_URL
+from app.migrations import SCHEMA_VERSION, migrate
 
-import sqlite3
-
-DB_PATH = "dexsystem.db"
-
-def add_column(cursor, table_name, column_name, column_type):
-    try:
-        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
-        print(f"Added column {column_name} to {table_name}")
-    except sqlite3.OperationalError as e:
-        if "duplicate column" in str(e):
-            print(f"Column {column_name} already exists in {table_name}")
-        else:
-            print(f"Error adding {column_name}: {e}")
-
-def migrate():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    add_column(cursor, "sales", "note", "TEXT")
-    add_column(cursor, "sales", "custom_amount", "FLOAT DEFAULT 0")
-    
-    conn.commit()
-    conn.close()
-    print("Migration complete.")
 
 if __name__ == "__main__":
-    migrate()
+    print(f"Migrating {SQLALCHEMY_DATABASE_URL.split('@')[-1]} ...")
+    for change in migrate():
+        print(change)
+    print(f"Migration complete. (schema version {SCHEMA_VERSION})")
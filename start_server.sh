@@ -14,6 +14,7 @@ echo ""
 # 啟動 FastAPI (背景執行)
 echo "🔧 啟動 FastAPI backend (port 8000)..."
 source venv/bin/activate
+python migrate_db.py
 uvicorn app.main:app --host 0.0.0.0 --port 8000 --reload &
 FASTAPI_PID=$!
 
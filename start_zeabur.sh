@@ -7,17 +7,26 @@ echo "👤 User: $(whoami)"
 # Force stdout/stderr flushing
 export PYTHONUNBUFFERED=1
 
+# Worker count: default to one per CPU core (override with WEB_CONCURRENCY)
+WEB_CONCURRENCY=${WEB_CONCURRENCY:-$(nproc 2>/dev/null || echo 1)}
+
+# 0. Create/upgrade tables once before forking workers (the API no longer does this at import)
+echo "🗄️ Migrating database schema..."
+python migrate_db.py || exit 1
+
 # 1. Start FastAPI backend (Background)
-echo "🔧 Starting FastAPI backend..."
-python -m uvicorn app.main:app --host 127.0.0.1 --port 8000 --log-level info &
+# Salary rules live in the database with a version number, so every worker
+# sees rule changes within VERSION_POLL_SECONDS.
+echo "🔧 Starting FastAPI backend with $WEB_CONCURRENCY worker(s)..."
+python -m uvicorn app.main:app --host 127.0.0.1 --port 8000 --log-level info --workers "$WEB_CONCURRENCY" &
 FASTAPI_PID=$!
 echo "🆔 FastAPI PID: $FASTAPI_PID"
 
-# Wait loop to ensure FastAPI is up
-echo "⏳ Waiting for FastAPI to accept connections..."
-for i in {1..10}; do
-    if python -c "import socket; s = socket.socket(); s.connect(('127.0.0.1', 8000)); s.close()" 2>/dev/null; then
-        echo "✅ FastAPI is running!"
+# Wait loop: poll the readiness endpoint (DB reachable + schema up to date)
+echo "⏳ Waiting for FastAPI to become ready..."
+for i in {1..80}; do
+    if python -c "import urllib.request; urllib.request.urlopen('http://127.0.0.1:8000/healthz', timeout=1)" 2>/dev/null; then
+        echo "✅ FastAPI is ready!"
         break
     fi
     
@@ -27,7 +36,7 @@ for i in {1..10}; do
         exit 1
     fi
     
-    sleep 2
+    sleep 0.25
 done
 
 # 2. Start Streamlit frontend (Foreground)